@@ -5,9 +5,26 @@
 # Usage for package bxxyyy:
 #   cd groups/bxx/bxxyyy
 #   component_cycles.py *.h *.cpp
+#
+# or, using an index written by `dependency-check.py --write-index <file>`
+# (which considers only dependencies not marked "for testing only"):
+#   component_cycles.py --index <file>
+#
+# This lists each cluster of mutually-dependent components (i.e., each
+# strongly-connected component of the dependency graph), which takes time
+# linear in the size of the graph.  With `--cycles`, the elementary cycles
+# within each cluster are listed too, stopping after `--max-cycles` (default
+# 1000) cycles and ignoring cycles longer than `--max-length` components;
+# either option implies `--cycles`.
 
 import sys
 import re
+import os
+import mmap
+import pickle
+import textwrap
+
+default_max_cycles = 1000  # Default limit for `--cycles`
 
 def normalize_cycle(cycle):
     """Takes the 'cycle' list and normalize it such that it starts with the lowest-valued node name."""
@@ -22,61 +39,259 @@ def normalize_cycle(cycle):
     cycle.append(cycle_start)
     return cycle
 
-def find_cycles(graph):
-    def dfs(node, visited, path):
-        visited[node] = True
-        path.append(node)
+def successors(graph, node, members):
+    """Return the sorted neighbors of `node` in `graph` that are in
+    `members`, ignoring single-node cycles"""
+    return sorted(neighbor for neighbor in graph.get(node, ())
+                  if neighbor != node and neighbor in members)
 
-        for neighbor in graph.get(node, []):
-            if neighbor == node:
-                continue  # Ignore single-node cycles
-            elif neighbor in path:  # Cycle found
-                cycle_start = path.index(neighbor)
-                cycle = normalize_cycle(path[cycle_start:])
-                cycles.add(tuple(cycle))
-            elif not visited.get(neighbor, False):
-                dfs(neighbor, visited, path)
-
-        path.pop()
-        visited[node] = False
+def strongly_connected(graph, members = None):
+    """Return a list of the strongly-connected components of `graph` (or of
+    the subgraph induced by the set `members`, if specified) having more
+    than one node, each as a sorted list, using an iterative version of
+    Tarjan's algorithm that runs in time linear in the size of the graph"""
+    if members is None:
+        members = graph.keys()
+    index   = { }   # Order of discovery
+    lowlink = { }
+    on_stack = set()
+    stack   = []
+    ret     = []
+    for root in sorted(members):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(graph, root, members)))]
+        while work:
+            node, neighbors = work[-1]
+            for neighbor in neighbors:
+                if neighbor not in index:
+                    index[neighbor] = lowlink[neighbor] = len(index)
+                    stack.append(neighbor)
+                    on_stack.add(neighbor)
+                    work.append(
+                        (neighbor,
+                         iter(successors(graph, neighbor, members))))
+                    break
+                elif neighbor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[neighbor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        ret.append(sorted(component))
+    return sorted(ret)
 
+def find_cycles(graph, max_cycles = None, max_length = None):
+    """Return the tuple `(cycles, truncated)`, where `cycles` is a set of the
+    elementary cycles in `graph`, each as a tuple normalized by
+    `normalize_cycle`, found using Johnson's algorithm within each
+    strongly-connected component.  Stop after `max_cycles` cycles, if
+    specified, and ignore cycles of more than `max_length` components, if
+    specified.  `truncated` is true if there are more than `max_cycles`
+    cycles, i.e., if the search stopped early."""
     cycles = set()
-    visited = {}
+    for component in strongly_connected(graph):
+        # Number the nodes in sorted order, so that cycles are found in a
+        # deterministic order
+        number     = { node: i for i, node in enumerate(component) }
+        successors = [sorted(number[neighbor] for neighbor in graph[node]
+                             if neighbor != node and neighbor in number)
+                      for node in component]
+        for start in range(len(component)):
+            if not johnson_circuits(component, successors, start, cycles,
+                                    max_cycles, max_length):
+                return cycles, True
+    return cycles, False
 
-    for node in graph.keys():
-        if not visited.get(node, False):
-            dfs(node, visited, [])
+def johnson_circuits(nodes, successors, start, cycles, max_cycles,
+                     max_length):
+    """Add to `cycles` the elementary cycles through `nodes[start]` that
+    visit only higher-numbered nodes, where `successors[i]` lists the
+    numbers of the nodes that `nodes[i]` depends on, and return false if
+    there are more than `max_cycles` cycles.  When a path is cut short by
+    `max_length`, its nodes are treated as if they had led to a cycle, so
+    that they are not left blocked."""
+    blocked  = { start }
+    blockers = { }  # Map node to nodes to unblock when it is unblocked
 
-    return cycles
+    def unblock(node):
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            if node in blocked:
+                blocked.discard(node)
+                pending.extend(blockers.pop(node, ()))
 
-def build_dependency_graph(cpp_files):
-    include_pattern = re.compile(r'^\s*#\s*include\s+["<](\w+)\.h[">]',
-                                 re.MULTILINE)
+    path  = [start]
+    found = [False]
+    work  = [iter(successors[start])]
+    while work:
+        for neighbor in work[-1]:
+            if neighbor < start:
+                continue
+            elif neighbor == start:
+                cycle = tuple(normalize_cycle([nodes[node] for node in path]))
+                if (max_cycles is not None and len(cycles) >= max_cycles and
+                    cycle not in cycles):
+                    return False  # One cycle too many
+                cycles.add(cycle)
+                found[-1] = True
+            elif neighbor not in blocked:
+                if max_length is not None and len(path) >= max_length:
+                    found[-1] = True
+                    continue
+                path.append(neighbor)
+                found.append(False)
+                blocked.add(neighbor)
+                work.append(iter(successors[neighbor]))
+                break
+        else:
+            work.pop()
+            node       = path.pop()
+            node_found = found.pop()
+            if node_found:
+                unblock(node)
+            else:
+                for neighbor in successors[node]:
+                    if neighbor > start:
+                        blockers.setdefault(neighbor, set()).add(node)
+            if found:
+                found[-1] = found[-1] or node_found
+    return True
 
+# Starting the pattern with a literal `#` (rather than `^\s*`) lets the regex
+# engine skip quickly from one `#` to the next; `scan_content` then checks
+# that only whitespace precedes the `#` on its line.
+include_pattern = re.compile(rb'#\s*include\s+["<](\w+)\.h[">]')
+
+def scan_includes(file_name):
+    """Return the set of names of the `.h` files included by `file_name`,
+    without their suffix.  The file is scanned as bytes (memory-mapped if it
+    is large) rather than being decoded."""
+    with open(file_name, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < 256 * 1024:
+            return scan_content(file.read())
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return scan_content(content)
+
+def scan_content(content):
+    ret = set()
+    for match in include_pattern.finditer(content):
+        start      = match.start()
+        line_start = content.rfind(b'\n', 0, start) + 1
+        if line_start == start or content[line_start:start].isspace():
+            ret.add(match[1].decode('ascii'))
+    return ret
+
+def build_dependency_graph(cpp_files):
     components_dict = {}
 
     for file_name in cpp_files:
-        with open(file_name, 'r') as file:
-            file_content = file.read()
-            component_name = file_name.split('.')[0]
+        component_name = file_name.split('.')[0]
+        referenced_components = scan_includes(file_name)
 
-            referenced_components = \
-                set(include_pattern.findall(file_content))
+        if component_name not in components_dict:
+            components_dict[component_name] = set()
 
-            if component_name not in components_dict:
-                components_dict[component_name] = set()
-
-            components_dict[component_name].update(referenced_components)
+        components_dict[component_name].update(referenced_components)
 
     return components_dict
 
+def load_dependency_index(index_file_name):
+    """Return the dependency graph stored in the specified index file, as
+    written by `dependency-check.py --write-index`"""
+    with open(index_file_name, 'rb') as index_file:
+        index = pickle.load(index_file)
+    if (not isinstance(index, dict) or
+        index.get("format") != "dependency-check-index" or
+        index.get("version") != 1):
+        sys.exit(f"{index_file_name}: not a version 1 dependency index")
+
+    names   = index["components"]
+    offsets = index["deps_offsets"]
+    deps    = index["deps"]
+    return { name: set(names[dep] for dep in deps[offsets[i]:offsets[i + 1]])
+             for i, name in enumerate(names) }
+
+def usage(error_str = None):
+    if error_str is not None:
+        print(error_str, file=sys.stderr)
+    print("Usage: component_cycles.py [--cycles] [--max-cycles <n>] "
+          "[--max-length <n>]\n"
+          "                           (--index <file> | <file>...)",
+          file=sys.stderr)
+    sys.exit(1)
+
+def process_args(argv):
+    """Return the tuple `(graph, list_cycles, max_cycles, max_length)` for
+    the specified command-line arguments"""
+    index_file  = None
+    list_cycles = False
+    max_cycles  = default_max_cycles
+    max_length  = None
+    files       = []
+    args = iter(argv)
+    for arg in args:
+        if arg == "--cycles":
+            list_cycles = True
+        elif arg in ("--max-cycles", "--max-length"):
+            value = next(args, "")
+            if not value.isdigit() or int(value) == 0:
+                usage(f"{arg} requires a positive numeric argument")
+            list_cycles = True
+            if arg == "--max-cycles":
+                max_cycles = int(value)
+            else:
+                max_length = int(value)
+        elif arg == "--index":
+            index_file = next(args, None)
+            if index_file is None:
+                usage("Missing argument for --index")
+        elif arg.startswith("--"):
+            usage(f"Invalid argument: {arg}")
+        else:
+            files.append(arg)
+    if (index_file is None) == (not files):
+        usage()
+    graph = load_dependency_index(index_file) if index_file is not None \
+        else build_dependency_graph(files)
+    return graph, list_cycles, max_cycles, max_length
+
 if __name__ == "__main__":
-    dep_graph = build_dependency_graph(sys.argv)
+    dep_graph, list_cycles, max_cycles, max_length = \
+        process_args(sys.argv[1:])
 
-    cycles_found = find_cycles(dep_graph)
-    if cycles_found:
+    clusters = strongly_connected(dep_graph)
+    if not clusters:
+        print("No cycles found in the dependency graph.")
+        sys.exit(0)
+
+    print("Cyclic clusters found:")
+    for cluster in clusters:
+        print(f"{len(cluster)} components:")
+        print(textwrap.fill(" ".join(cluster), initial_indent="    ",
+                            subsequent_indent="    ",
+                            break_on_hyphens=False))
+
+    if list_cycles:
+        cycles_found, truncated = find_cycles(dep_graph, max_cycles,
+                                              max_length)
+        print()
         print("Cycles found:")
-        for cycle in sorted(list(cycles_found)):
+        for cycle in sorted(cycles_found):
             print(" -> ".join(cycle))
-    else:
-        print("No cycles found in the dependency graph.")
+        if truncated:
+            print(f"(limit of {max_cycles} cycles reached)")
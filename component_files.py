@@ -4,31 +4,48 @@ import sys
 import re
 import os
 
-component_re = re.compile(r'\.(h|cpp|([0-9]+\.)?t\.cpp)?$')
+component_re      = re.compile(r'\.(h|cpp|([0-9]+\.)?x?t\.cpp)?$')
+component_file_re = re.compile(r'^(\w+)\.(h|cpp|([0-9]+\.)?x?t\.cpp)$')
+
+directory_indexes = { }   # Map directory to `DirectoryIndex` result
+
+def DirectoryIndex(directory):
+    """Return a map from the name of each component in `directory` to the
+    set of suffixes (e.g., `.h`, `.cpp`, `.xt.cpp`, `.1.t.cpp`) of its files,
+    building it with a single directory scan the first time it is needed"""
+    if directory not in directory_indexes:
+        index = { }
+        with os.scandir(directory or '.') as entries:
+            for entry in entries:
+                match = component_file_re.match(entry.name)
+                if match:
+                    index.setdefault(match[1], set()).add(
+                        entry.name[len(match[1]):])
+        directory_indexes[directory] = index
+    return directory_indexes[directory]
 
 def ComponentFiles(*paths):
     """Return a tuple of component files for the given path(s)"""
+    files = []
     for path in paths:
-        component_path = component_re.sub('', path)
-        files = [ component_path + ".h", component_path + ".cpp" ]
-        if os.path.exists(component_path + ".0.t.cpp"):
+        component_path  = component_re.sub('', path)
+        directory, name = os.path.split(component_path)
+        suffixes = DirectoryIndex(directory).get(name, ())
+        files += [ component_path + ".h", component_path + ".cpp" ]
+        if ".0.t.cpp" in suffixes:
             # Has numbered tests
-            files.append(component_path + ".0.t.cpp")
+            test_num = 0
+            while f".{test_num}.t.cpp" in suffixes:
+                files.append(f"{component_path}.{test_num}.t.cpp")
+                test_num += 1
+        elif ".xt.cpp" in suffixes:
+            # Has split tests
+            files.append(component_path + ".xt.cpp")
         else:
-            # Does not have numbered test files
+            # Does not have numbered or split test files
             files.append(component_path + ".t.cpp")
-            return tuple(files)
-        test_num = 1
-        while True:
-            test_path = component_path + '.' + str(test_num) + ".t.cpp"
-            if os.path.exists(test_path):
-                files.append(test_path)
-                test_num += 1
-            else:
-                break
-        return tuple(files)
+    return tuple(files)
 
 if __name__ == "__main__":
-    for file in sys.argv[1:]:
-        for cpt_file in ComponentFiles(file):
-            print(cpt_file + ' ', end='')
+    for cpt_file in ComponentFiles(*sys.argv[1:]):
+        print(cpt_file + ' ', end='')
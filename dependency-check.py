@@ -3,69 +3,428 @@
 import sys
 import re
 import os
+import json
+import mmap
+import time
+import select
+import signal
+import heapq
+import struct
+import pickle
+import cProfile
+import hashlib
+import subprocess
 import textwrap
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from array import array
 from glob import glob
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
 # Global variables
 progname    = "PROGRAM"
 verbose     = False
-package     = None
+watch       = False  # Stay resident and re-check after every change
 package_dir = None
+repo_dir    = None   # Root of the repository in `--repo` mode
+index_file  = None   # Output file for `--write-index`
+jsonl_file  = None   # Output file for `--jsonl`
+report_file = sys.stdout  # Stream for the report (`stderr` if an output
+                          # file is `-`)
+queries     = []     # `(query, component...)` tuples (`--depends` etc.)
+changed_files = None # Files named by `--changed` (empty, not `None`, in
+                     # change-impact mode even if none are named)
+git_range     = None # Revision range named by `--since`
+schedule_file   = None    # Output file for `--schedule`
+schedule_format = "list"  # `list`, `make` or `ninja` (`--schedule-format`)
+durations       = { }     # Map name to seconds, from `--durations`
+revisions     = None  # `(old, new)` revisions for `--diff-revisions`
+use_cache   = True
+preamble_only = False  # Stop scanning headers at `namespace` (`--preamble`)
+bench_scanner = False  # Benchmark the include scanners (`--bench-scanner`)
+profiling     = False  # Print phase times and counters (`--profile`)
+profile_file  = None   # Output file for `--profile-dump`
+jobs        = 1     # Scan in a process pool of this size (`--jobs`)
+executor    = None
+cache_dir   = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                          os.path.expanduser("~/.cache")),
+                           "dependency-check")
 
-suffix_re = re.compile(r"\.(h|cpp|([0-9]+\.)?t\.cpp)?$")
+suffix_re = re.compile(r"\.(h|cpp|([0-9]+\.)?x?t\.cpp)?$")
 cpp03_re  = re.compile(r"_cpp03$")
+component_file_re = re.compile(r"^(\w+)\.(h|cpp|([0-9]+\.)?x?t\.cpp)$")
 
-include_pattern = r'^\s*#\s*include\s+["<](PKG_\w+).h[">](?i:( *//.*\btesting\b)?)'
-include_re      = None
+# Matches every `#include` of a `.h` file.  Includes of files that are not
+# components of a known package are filtered out after matching so that the
+# parsed include list of a file does not depend on the packages being checked
+# (and can, therefore, be cached) and so that a single pass over each file
+# finds its dependencies on every package.
+include_pattern = r'^\s*#\s*include\s+["<](\w+).h[">](?i:( *//.*\btesting\b)?)'
+include_re      = re.compile(include_pattern, re.MULTILINE)
 
-components = { }
+# Bytes equivalent of `include_pattern`, used by `scan_includes`.  Starting
+# the pattern with a literal `#` (rather than `^\s*`) lets the regex engine
+# skip quickly from one `#` to the next; `scan_includes` then checks that only
+# whitespace precedes the `#` on its line.
+include_bytes_re = re.compile(
+    rb'#\s*include\s+["<](\w+).h[">](?i:( *//.*\btesting\b)?)')
+
+# End of the include preamble of a BDE header
+namespace_bytes_re = re.compile(rb'\nnamespace\b')
+
+# Files at least this large are memory-mapped by `scan_file`
+mmap_threshold = 256 * 1024
+
+components         = { }
+component_ids      = { }   # Map component name to interned integer ID
+component_names    = []    # Component name for each ID
+component_list     = []    # `component_stats` for each ID (once created)
+include_pairs      = { }   # Interned `(component, testing-only)` pairs
+suffix_sets        = { }   # Interned `directory_index` suffix sets
+component_packages = { }   # Map component name to package, from .mem files
+package_dirs       = { }   # Map package name to package directory
+package_groups     = { }   # Map package name to package group
+dfs_counter        = 0     # Next depth-first discovery index
+include_caches     = { }   # Map package directory to `include_cache`
+directory_indexes  = { }   # Map directory to `directory_index` result
+
+# Profiling data, printed by `--profile`
+counters      = Counter()  # Hot-path event counts
+phase_times   = { }        # Map phase name to `[wall-time, cpu-time]`
+slowest_files = []         # Min-heap of the `(seconds, path)` slowest scans
+num_slowest   = 10
+
+# Bump this number whenever the format of the cached data changes
+cache_version = 1
+
+# Bump this number whenever the format of the `--write-index` file changes
+index_format  = "dependency-check-index"
+index_version = 1
+
+# Bump this number whenever the format of the saved `reachability_index`
+# changes
+reachability_version = 1
+
+def directory_index(directory):
+    """Return a map from the name of each component in `directory` to the
+    set of suffixes (e.g., `.h`, `.cpp`, `.xt.cpp`, `.1.t.cpp`) of its files,
+    building it with a single directory scan the first time it is needed"""
+    if directory not in directory_indexes:
+        counters["directory scans"] += 1
+        with os.scandir(directory or '.') as entries:
+            directory_indexes[directory] = \
+                index_file_names(entry.name for entry in entries)
+    return directory_indexes[directory]
+
+def index_file_names(file_names):
+    """Return the `directory_index` result for a directory containing
+    `file_names`"""
+    index = { }
+    for file_name in file_names:
+        match = component_file_re.match(file_name)
+        if match:
+            index.setdefault(match[1], set()).add(file_name[len(match[1]):])
+    # Most components have the same set of suffixes, so share them
+    for name, suffixes in index.items():
+        suffixes    = frozenset(suffixes)
+        index[name] = suffix_sets.setdefault(suffixes, suffixes)
+    return index
 
 def component_files(*paths):
     """Return a tuple of component files for the given path(s)"""
+    files = []
     for path in paths:
-        component_path = suffix_re.sub('', path)
-        files = [ component_path + ".h", component_path + ".cpp" ]
-        if os.path.exists(component_path + ".0.t.cpp"):
+        component_path  = suffix_re.sub('', path)
+        directory, name = os.path.split(component_path)
+        suffixes = directory_index(directory).get(name, ())
+        files += [ component_path + ".h", component_path + ".cpp" ]
+        if ".0.t.cpp" in suffixes:
             # Has numbered tests
-            files.append(component_path + ".0.t.cpp")
-        elif os.path.exists(component_path + ".xt.cpp"):
+            test_num = 0
+            while f".{test_num}.t.cpp" in suffixes:
+                files.append(f"{component_path}.{test_num}.t.cpp")
+                test_num += 1
+        elif ".xt.cpp" in suffixes:
             # Has split tests
             files.append(component_path + ".xt.cpp")
-            return tuple(files)
         else:
             # Does not have numbered or split test files
             files.append(component_path + ".t.cpp")
-            return tuple(files)
-        test_num = 1
-        while True:
-            test_path = component_path + '.' + str(test_num) + ".t.cpp"
-            if os.path.exists(test_path):
-                files.append(test_path)
-                test_num += 1
+    return tuple(files)
+
+def scan_includes(content, end = None):
+    """Return a tuple of `(component, testing-only)` pairs, one for each
+    `#include` in `content[:end]`, where `content` is a bytes-like object
+    (e.g., an `mmap`).  The result is the same as applying `include_re` to
+    the decoded content, but without decoding or copying it."""
+    if end is None:
+        end = len(content)
+    ret = []
+    for match in include_bytes_re.finditer(content, 0, end):
+        start      = match.start()
+        line_start = content.rfind(b'\n', 0, start) + 1
+        if line_start == start or content[line_start:start].isspace():
+            ret.append((match[1].decode('ascii'), match[2] is not None))
+    return tuple(ret)
+
+def scan_file(file_name, preamble_only = False):
+    """Read `file_name` and return a tuple, `(digest, includes)`, where
+    `digest` is a hash of the file contents and `includes` is a tuple of
+    `(component, testing-only)` pairs, one for each `#include` in the file.
+    Large files are memory-mapped rather than read.  If `preamble_only` is true
+    and `file_name` is a header, includes after the first line beginning
+    with `namespace` are ignored."""
+    with open(file_name, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < mmap_threshold:
+            # Mapping a small file costs more than reading it
+            return scan_content(file.read(), file_name, preamble_only)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return scan_content(content, file_name, preamble_only)
+
+def scan_content(content, file_name, preamble_only):
+    """Return the `scan_file` result for the specified bytes-like
+    `content` of `file_name`"""
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    end    = None
+    if preamble_only and file_name.endswith(".h"):
+        match = namespace_bytes_re.search(content)
+        end   = match.start() if match else None
+    return digest, scan_includes(content, end)
+
+def timed_scan_file(file_name, preamble_only = False):
+    """Return the tuple `(scan_file(file_name, preamble_only), seconds)`"""
+    start_time = time.perf_counter()
+    result     = scan_file(file_name, preamble_only)
+    return result, time.perf_counter() - start_time
+
+def scan_file_text(file_name):
+    """Reference implementation of `scan_file` (without `preamble_only`)
+    that reads and decodes the whole file and applies `include_re` to it.
+    Used by `--bench-scanner`."""
+    with open(file_name, 'rb') as file:
+        raw_content = file.read()
+    digest       = hashlib.blake2b(raw_content, digest_size=16).digest()
+    file_content = raw_content.decode('utf-8', errors='replace')
+    includes     = tuple((inc_component, testing != "") for
+                         inc_component, testing in
+                         include_re.findall(file_content))
+    return digest, includes
+
+def benchmark_scanners(paths, repetitions = 5):
+    """Compare the speed of `scan_file` and `scan_file_text` on `paths`,
+    checking that they produce identical results, and print the results"""
+    results = { }
+    for scanner in (scan_file_text, scan_file):
+        best = None
+        for i in range(repetitions):
+            start_time = time.perf_counter()
+            results[scanner] = [scanner(path) for path in paths]
+            elapsed = time.perf_counter() - start_time
+            best    = elapsed if best is None else min(best, elapsed)
+        print(f"{scanner.__name__:>15}: {best * 1000:9.2f} ms " +
+              f"for {len(paths)} files (best of {repetitions})")
+
+    mismatches = [path for path, text_result, result in
+                  zip(paths, results[scan_file_text], results[scan_file])
+                  if text_result != result]
+    for path in mismatches:
+        print(f"Mismatch: {path}")
+    return len(mismatches)
+
+class include_cache:
+    """Persistent map from the files in one package directory to the
+    includes parsed from them.  An entry is reused if the size and
+    modification time of the file are unchanged; otherwise, the file is
+    re-read and, if its contents hash to the same digest, the includes are
+    still reused without being re-parsed."""
+
+    def __init__(self, directory):
+        self.directory  = os.path.abspath(directory)
+        self.cache_file = os.path.join(
+            cache_dir,
+            os.path.basename(self.directory) + '-' +
+            hashlib.blake2b(self.directory.encode(),
+                            digest_size=8).hexdigest() +
+            ("-preamble" if preamble_only else "") + ".pickle")
+        self.entries = { }
+        self.current = { }    # Includes of files validated during this run
+        self.dirty   = False
+        if not use_cache:
+            return
+        try:
+            with open(self.cache_file, 'rb') as file:
+                version, entries = pickle.load(file)
+            if version == cache_version:
+                self.entries = entries
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass  # Missing or corrupt cache; start over
+
+    def stale_files(self, file_names):
+        """Return a list of `(file_name, stat)` pairs for the files in
+        `file_names` whose cached includes are out of date.  The includes for
+        the other files become available via `includes`."""
+        stale = []
+        for file_name in file_names:
+            if file_name in self.current:
+                continue
+            counters["files stat'ed"] += 1
+            stat  = os.stat(os.path.join(self.directory, file_name))
+            entry = self.entries.get(file_name)
+            if (entry is not None and entry[0] == stat.st_size and
+                entry[1] == stat.st_mtime_ns):
+                self.current[file_name] = entry[3]
             else:
-                break
-        return tuple(files)
+                stale.append((file_name, stat))
+        return stale
+
+    def update(self, file_name, stat, digest, includes):
+        """Record the result of `scan_file` for `file_name`"""
+        entry = self.entries.get(file_name)
+        if entry is not None and entry[2] == digest:
+            includes = entry[3]  # Touched but unchanged
+        else:
+            # The same includes appear in many files, so share them
+            includes = tuple(include_pairs.setdefault(pair, pair)
+                             for pair in includes)
+        self.entries[file_name] = \
+            (stat.st_size, stat.st_mtime_ns, digest, includes)
+        self.current[file_name] = includes
+        self.dirty = True
+
+    def includes(self, file_name):
+        """Return the `(component, testing-only)` pairs for `file_name`,
+        which is relative to the cache directory"""
+        if file_name not in self.current:
+            scan_files({ self: (file_name,) })
+        return self.current[file_name]
+
+    def save(self):
+        if not use_cache or not self.dirty:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file and rename so that a concurrent or
+        # interrupted run never sees a partially-written cache.
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as file:
+            pickle.dump((cache_version, self.entries), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+def get_executor(num_files):
+    """Return the process pool to use for parsing `num_files` files, or
+    `None` if they should be parsed in this process"""
+    global executor
+    if jobs <= 1 or num_files < 2 * jobs:
+        return None
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    return executor
+
+def get_include_cache(directory):
+    """Return the `include_cache` for `directory`, loading it if needed"""
+    if directory not in include_caches:
+        include_caches[directory] = include_cache(directory)
+    return include_caches[directory]
+
+def scan_files(files_by_cache):
+    """Bring the includes for the files in the specified map from
+    `include_cache` to file names up to date.  Files that are out of date
+    in any of the caches are parsed as one batch, in parallel if there are
+    enough of them to be worth the overhead of the process pool."""
+    stale = [(cache, file_name, stat)
+             for cache, file_names in files_by_cache.items()
+             for file_name, stat in cache.stale_files(file_names)]
+
+    paths = [os.path.join(cache.directory, file_name)
+             for cache, file_name, stat in stale]
+    pool    = get_executor(len(paths))
+    scanner = timed_scan_file if profiling else scan_file
+    if pool is None:
+        results = map(scanner, paths, repeat(preamble_only))
+    else:
+        results = pool.map(scanner, paths, repeat(preamble_only),
+                           chunksize=max(1, len(paths) // (4 * jobs)))
+
+    for (cache, file_name, stat), path, result in zip(stale, paths, results):
+        if profiling:
+            result, seconds = result
+            if len(slowest_files) < num_slowest:
+                heapq.heappush(slowest_files, (seconds, path))
+            else:
+                heapq.heappushpop(slowest_files, (seconds, path))
+        digest, includes = result
+        counters["files read"]      += 1
+        counters["bytes read"]      += stat.st_size
+        counters["include matches"] += len(includes)
+        cache.update(file_name, stat, digest, includes)
+
+def component_package(component_name):
+    """Return the name of the package containing `component_name`"""
+    if component_name in component_packages:
+        return component_packages[component_name]
+    return sys.intern(component_name.split('_')[0])
+
+def component_id(component_name):
+    """Return the interned integer ID for `component_name`, assigning one if
+    necessary"""
+    if component_name not in component_ids:
+        component_name = sys.intern(component_name)
+        component_ids[component_name] = len(component_names)
+        component_names.append(component_name)
+        component_list.append(None)
+    return component_ids[component_name]
+
+def id_array(names):
+    """Return an array of the IDs of the specified component `names`,
+    sorted by name"""
+    return array('i', (component_id(name) for name in sorted(names)))
+
+def cycle_key(cycle):
+    """Sort key for printing cycles in a deterministic order"""
+    return [(component_names[edge >> 1], edge & 1) for edge in cycle]
 
 class component_stats:
+    """Dependency information for one component.  There can be hundreds of
+    thousands of these, so they have no `__dict__`.  Dependencies are arrays
+    of component IDs, sorted by name; the much rarer sets of dependencies
+    with warnings are tuples of names, and cycles are tuples of
+    `ID * 2 + testdep` edges, stored in a set that is created only when a
+    cycle is found."""
+
+    __slots__ = ("component_name", "id", "package", "directory",
+                 "visiting", "visited", "dfs_index", "lowlink",
+                 "component_deps", "testonly_deps", "excess_test_deps",
+                 "false_test_deps", "component_cycles", "testonly_cycles",
+                 "component_level", "testonly_level",
+                 "error_count", "warning_count")
 
     def __init__(self, component_name):
         global components
         assert(component_name not in components)
 
-        self.component_name            = component_name
-        self.visiting                  = False
+        self.id                        = component_id(component_name)
+        self.component_name            = component_names[self.id]
+        self.package                   = component_package(component_name)
+        self.directory                 = package_dirs[self.package]
+        self.visiting                  = False # On the SCC stack
         self.visited                   = False
-        self.component_deps            = set()
-        self.testonly_deps             = set()
-        self.excess_test_deps          = set()
-        self.false_test_deps           = set()
-        self.component_cycles          = set()
-        self.testonly_cycles           = set()
+        self.dfs_index                 = None  # Order of discovery
+        self.lowlink                   = None
+        self.component_deps            = array('i')
+        self.testonly_deps             = array('i')
+        self.excess_test_deps          = ()
+        self.false_test_deps           = ()
+        self.component_cycles          = None
+        self.testonly_cycles           = None
         self.component_level           = 0     # excludes test driver
         self.testonly_level            = 0     # includes test driver
         self.error_count               = 0
         self.warning_count             = 0
-        components[component_name] = self
+        components[self.component_name] = self
+        component_list[self.id]          = self
 
     def __less__(self, other):
         return self.component_name < other.component_name
@@ -77,11 +436,12 @@ class component_stats:
 
         ret += f"    Num test-only dependencies = {len(self.testonly_deps)}\n"
         if verbose and self.testonly_deps:
-            ret += f"        Test-only dependencies = {self.testonly_deps}\n"
+            ret += "        Test-only dependencies = " + \
+                f"{set(component_names[id] for id in self.testonly_deps)}\n"
 
         if self.component_cycles:
             ret += "    Error: Dependency cycles detected:\n"
-            for cycle in self.component_cycles:
+            for cycle in sorted(self.component_cycles, key=cycle_key):
                 ret += self.format_cycle(cycle) + '\n'
 
         if self.excess_test_deps:
@@ -91,7 +451,7 @@ class component_stats:
 
         if self.testonly_cycles:
             ret += "    Warning: Test-only dependency cycles:\n"
-            for cycle in self.testonly_cycles:
+            for cycle in sorted(self.testonly_cycles, key=cycle_key):
                 ret += self.format_cycle(cycle) + '\n'
 
         if self.component_level < self.testonly_level:
@@ -112,106 +472,179 @@ class component_stats:
 
         return ret
 
-    def format_cycle(self, cycle):
+    @staticmethod
+    def format_cycle(cycle):
         cycle_str = ""
-        for component, testdep in cycle:
-            cycle_str += component.component_name
-            cycle_str += " T-> " if testdep else " -> "
-        cycle_str += cycle[0][0].component_name
+        for edge in cycle:
+            cycle_str += component_names[edge >> 1]
+            cycle_str += " T-> " if edge & 1 else " -> "
+        cycle_str += component_names[cycle[0] >> 1]
         return '\n'.join(textwrap.wrap(cycle_str, width=79,
                                        initial_indent="        ",
                                        subsequent_indent="            ",
                                        break_long_words=False))
 
-    def visit(self, path = tuple()):
+    def dependencies(self):
+        """Generate `(component, testdep)` pairs for each direct dependency,
+        in deterministic order, with the non-test dependencies first"""
+        for dependency_id in self.component_deps:
+            yield component_list[dependency_id], False
+        for dependency_id in self.testonly_deps:
+            yield component_list[dependency_id], True
 
-        if self.visited: return
+    def dependency_names(self):
+        """Return the set of names of all direct dependencies"""
+        return set(component_names[dependency_id] for dependency_id in
+                   self.component_deps + self.testonly_deps)
 
-        if self.visiting:
-            # Found a cycle
-            self.record_cycle(path)
-            return
+    def visit(self):
+        """Compute the levels of this component and of every component it
+        depends on, reporting any cycles among them.  This is an iterative
+        version of Tarjan's strongly-connected-components algorithm: the
+        levels of each component are computed when its depth-first traversal
+        finishes and the cycles are reported once per strongly-connected
+        component (SCC) when the SCC is complete."""
+        if self.dfs_index is not None: return
 
-        self.get_direct_deps()
+        scc_stack = []
+        self.start_visit(scc_stack)
+        work = [(self, self.dependencies())]
+        while work:
+            component, dependencies = work[-1]
+            for dependency, testdep in dependencies:
+                if dependency.dfs_index is None:
+                    # Descend into dependency; resume this loop later
+                    dependency.start_visit(scc_stack)
+                    work.append((dependency, dependency.dependencies()))
+                    break
+                elif dependency.visiting:
+                    # Back or cross edge within the SCC being built
+                    component.lowlink = min(component.lowlink,
+                                            dependency.dfs_index)
+            else:
+                # All dependencies traversed
+                work.pop()
+                component.compute_levels()
+                if work:
+                    parent = work[-1][0]
+                    parent.lowlink = min(parent.lowlink, component.lowlink)
+                if component.lowlink == component.dfs_index:
+                    scc = []
+                    while True:
+                        member = scc_stack.pop()
+                        member.visiting = False
+                        member.visited  = True
+                        scc.append(member)
+                        if member is component: break
+                    record_scc_cycles(scc)
+                    for member in scc:
+                        member.count_errors_and_warnings()
 
-        self.visiting = True
+    def start_visit(self, scc_stack):
+        global dfs_counter
+        self.dfs_index = self.lowlink = dfs_counter
+        dfs_counter   += 1
+        self.visiting  = True
+        scc_stack.append(self)
 
+    def compute_levels(self):
         # Note that our level is at least one more than the *test* level
         # (`testonly_level`) of components on which we depend, even when
         # traversing non-test dependencies.  That way, only level differences
         # corresponding to *this* component are reflected in the level
-        # variables.
+        # variables.  A dependency that is still being traversed (i.e., one
+        # that is part of a cycle) contributes its current level, which is
+        # zero.
         level = 1
-        for dependency_name in self.component_deps:
-            dependency = visit_by_name(dependency_name,
-                                       path + ((self, False),))
+        for dependency_id in self.component_deps:
+            dependency = component_list[dependency_id]
             level = max(level, dependency.testonly_level + 1)
         self.component_level = level
-        # print(f"test-only deps: {self.testonly_deps}\n")
-        for dependency_name in self.testonly_deps:
-            dependency = visit_by_name(dependency_name, path + ((self, True),))
+        for dependency_id in self.testonly_deps:
+            dependency = component_list[dependency_id]
             level = max(level, dependency.testonly_level + 1)
         self.testonly_level = level
 
-        self.visiting = False
-        self.visited  = True
+    def files(self):
+        """Return the names of the files of this component, relative to the
+        package directory"""
+        return tuple(os.path.basename(file_name) for file_name in
+                     component_files(os.path.join(self.directory,
+                                                  self.component_name)))
 
-        self.count_errors_and_warnings()
-
-        return
+    def test_drivers(self):
+        """Return the paths of the test drivers of this component that
+        exist"""
+        suffixes = directory_index(self.directory).get(self.component_name,
+                                                       ())
+        return [os.path.join(self.directory, file_name)
+                for file_name in self.files()[2:]
+                if file_name[len(self.component_name):] in suffixes]
 
     def get_direct_deps(self):
-        hdr_file, imp_file, *test_files = component_files(self.component_name)
+        hdr_file, imp_file, *test_files = self.files()
+
+        testonly_deps      = set()
+        excess_test_deps   = set()
+        self.warning_count = 0
 
-        self.component_deps = self.get_file_deps(hdr_file).union(
-            self.get_file_deps(imp_file, self.testonly_deps))
+        component_deps = self.get_file_deps(hdr_file).union(
+            self.get_file_deps(imp_file, testonly_deps))
         for test_file in test_files:
             for inc in self.get_file_deps(test_file):
-                if (inc not in self.component_deps and
-                    inc not in self.testonly_deps):
-                    self.testonly_deps.add(inc)
-                    self.excess_test_deps.add(inc)
+                if (inc not in component_deps and
+                    inc not in testonly_deps):
+                    testonly_deps.add(inc)
+                    excess_test_deps.add(inc)
                     self.warning_count += 1
-        self.false_test_deps = \
-            self.testonly_deps.intersection(self.component_deps)
-        self.testonly_deps   = \
-            self.testonly_deps.difference(self.false_test_deps)
+        false_test_deps = testonly_deps.intersection(component_deps)
+        testonly_deps   = testonly_deps.difference(false_test_deps)
+
+        self.component_deps   = id_array(component_deps)
+        self.testonly_deps    = id_array(testonly_deps)
+        self.excess_test_deps = tuple(sorted(excess_test_deps))
+        self.false_test_deps  = tuple(sorted(false_test_deps))
 
     def get_file_deps(self, file_name, testonly_deps = None):
         """Return a set of files `#include`d from `file_name`.  If
         `testonly_deps` is not None, segregate testing only includes into
         that set"""
-        with open(file_name, 'r') as file:
-            file_content = file.read()
-            pkg_includes = include_re.findall(file_content)
-            ret = set()
-            for pkg_include in pkg_includes:
-                inc_component = pkg_include[0]
-                testonly      = pkg_include[1] != ""
-                if inc_component == self.component_name:
-                    continue
-                elif inc_component.endswith("_cpp03"):
-                    continue
-                elif testonly_deps is None or not testonly:
-                    ret.add(inc_component)
-                else:
-                    testonly_deps.add(inc_component)
+        cache = get_include_cache(self.directory)
+        ret = set()
+        for inc_component, testonly in cache.includes(file_name):
+            inc_package = component_package(inc_component)
+            if inc_package not in package_dirs:
+                continue
+            elif repo_dir is None and inc_package != self.package:
+                continue  # Only `--repo` mode looks across packages
+            elif inc_component == inc_package + '_':
+                continue
+            elif inc_component == self.component_name:
+                continue
+            elif inc_component.endswith("_cpp03"):
+                continue
+            elif testonly_deps is None or not testonly:
+                ret.add(inc_component)
+            else:
+                testonly_deps.add(inc_component)
 
         return ret
 
-    def record_cycle(self, path):
-        # Find the start of the cycle in the path
-        cycle_start = next((i for i in range(len(path)) if path[i][0] == self))
-        cycle = path[cycle_start:]
-
-        # Record the cycle in every component that participates in it, starting
-        # with the ones starting with a test-only dependency.
+    def record_cycle(self, cycle):
+        """Record the specified `cycle`, a tuple of `(component, testdep)`
+        pairs starting with this component, in every component that
+        participates in it, starting with the ones starting with a test-only
+        dependency."""
+        edges    = tuple(component.id * 2 + testdep
+                         for component, testdep in cycle)
         testonly = False
         for i in range(len(cycle)):
             component, testdep = cycle[i]
             if testdep:
                 testonly = True  # Found at least one test-only dependedency
-                component.testonly_cycles.add(cycle[i:]+cycle[:i])
+                if component.testonly_cycles is None:
+                    component.testonly_cycles = set()
+                component.testonly_cycles.add(edges[i:]+edges[:i])
 
         # If any deps are test-only stop here; do not report non-test-only
         # cycle for remaining components.
@@ -219,7 +652,20 @@ class component_stats:
 
         for i in range(len(cycle)):
             (component, testdep) = cycle[i]
-            component.component_cycles.add(cycle[i:]+cycle[:i])
+            if component.component_cycles is None:
+                component.component_cycles = set()
+            component.component_cycles.add(edges[i:]+edges[:i])
+
+    def reset_traversal(self):
+        """Forget the results of `visit` so that it can be run again"""
+        self.visiting         = False
+        self.visited          = False
+        self.dfs_index        = None
+        self.lowlink          = None
+        self.component_cycles = None
+        self.testonly_cycles  = None
+        self.component_level  = 0
+        self.testonly_level   = 0
 
     def count_errors_and_warnings(self):
         self.error_count   = 0
@@ -230,43 +676,1759 @@ class component_stats:
         if self.testonly_cycles:                       self.warning_count += 1
         if self.component_level < self.testonly_level: self.warning_count += 1
 
-def visit_by_name(component_name, path = tuple()):
+def visit_by_name(component_name):
 
-    if component_name in components:
-        component = components[component_name]
-    else:
-        component = component_stats(component_name)
-    component.visit(path)
+    component = components[component_name]
+    component.visit()
     return component
 
+def shortest_path(source, target, members, follow_testonly):
+    """Return the shortest path from `source` to `target` that stays within
+    the set of `members`, as a list of `(component, testdep)` pairs, one
+    for each dependency traversed, or `None` if there is no such path.  If
+    `source` is `target`, the path is a non-empty cycle.  Test-only
+    dependencies are traversed only if `follow_testonly` is true."""
+    # Breadth-first search; `previous` maps each component reached to the
+    # `(component, testdep)` dependency by which it was first reached.
+    previous = { }
+    frontier = [ source ]
+    while frontier and target not in previous:
+        next_frontier = []
+        for component in frontier:
+            for dependency, testdep in component.dependencies():
+                if testdep and not follow_testonly:
+                    break  # Non-test dependencies are generated first
+                if dependency in members and dependency not in previous:
+                    previous[dependency] = (component, testdep)
+                    next_frontier.append(dependency)
+        frontier = next_frontier
+
+    if target not in previous:
+        return None
+    path      = []
+    component = target
+    while True:
+        component, testdep = previous[component]
+        path.append((component, testdep))
+        if component is source: break
+    path.reverse()
+    return path
+
+def strongly_connected(nodes, successors):
+    """Return the list of strongly-connected components of the graph
+    consisting of `nodes` and the edges generated by `successors(node)`,
+    ignoring edges to nodes that are not in `nodes`.  Iterative version of
+    Tarjan's algorithm."""
+    index   = { }
+    lowlink = { }
+    stack   = []
+    on_stack = set()
+    sccs    = []
+    for root in nodes:
+        if root in index: continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, succs = work[-1]
+            for succ in succs:
+                if succ not in nodes:
+                    continue
+                elif succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(successors(succ))))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    scc = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        scc.append(member)
+                        if member is node: break
+                    sccs.append(scc)
+    return sccs
+
+def record_scc_cycles(scc):
+    """Report the cycles within the specified strongly-connected component,
+    `scc`.  Rather than enumerating every (possibly exponentially many)
+    cycle, report one shortest cycle through each test-only dependency that
+    closes a cycle and enough shortest non-test cycles that every component
+    that is on such a cycle reports at least one."""
+    if len(scc) < 2:
+        return  # Self-includes are ignored, so a singleton has no cycles
+
+    by_name = lambda component: component.component_name
+    members = set(scc)
+    for component in sorted(scc, key=by_name):
+        for dependency_id in component.testonly_deps:
+            dependency = component_list[dependency_id]
+            if dependency in members:
+                path = shortest_path(dependency, component, members, True)
+                component.record_cycle(((component, True),) + tuple(path))
+
+    # Non-test cycles can only occur within the SCCs of the subgraph
+    # formed by non-test dependencies.
+    normal_deps = lambda component: (component_list[dependency_id]
+                                     for dependency_id in
+                                     component.component_deps)
+    for normal_scc in strongly_connected(members, normal_deps):
+        if len(normal_scc) < 2: continue
+        normal_members = set(normal_scc)
+        for component in sorted(normal_scc, key=by_name):
+            if not component.component_cycles:
+                cycle = shortest_path(component, component,
+                                      normal_members, False)
+                component.record_cycle(tuple(cycle))
+
+def scan_components(component_names):
+    """Scan phase: parse the files of every component in `component_names`
+    and, transitively, of every component on which they depend, and create
+    the `component_stats` for each with its direct dependencies filled in.
+    Each wave of newly-discovered components is parsed as one batch so that
+    the files can be read in parallel.  Return the list of new components."""
+    ret     = []
+    pending = set(name for name in component_names if name not in components)
+    while pending:
+        wave = [component_stats(name) for name in sorted(pending)]
+        ret += wave
+        files_by_cache = { }
+        for component in wave:
+            cache = get_include_cache(component.directory)
+            files_by_cache.setdefault(cache, []).extend(component.files())
+        scan_files(files_by_cache)
+
+        discovered = set()
+        for component in wave:
+            component.get_direct_deps()
+            discovered.update(component.dependency_names())
+        pending = set(name for name in discovered if name not in components)
+    return ret
+
+def condensed_levels(graph):
+    """Return a tuple, `(levels, cycles)`, for the specified `graph`, a map
+    from each node to the set of nodes on which it depends.  `levels` maps
+    each node to its level number and `cycles` is a sorted list of the
+    sorted lists of nodes in each cycle.  The nodes of a cycle share a
+    level, one higher than anything else the cycle depends on."""
+    levels = { }
+    cycles = []
+    # `strongly_connected` returns each SCC after all SCCs it depends on
+    for scc in strongly_connected(graph, lambda node: graph[node]):
+        members = set(scc)
+        level   = 1 + max((levels[dependency] for node in scc
+                           for dependency in graph[node]
+                           if dependency not in members), default=0)
+        for node in scc:
+            levels[node] = level
+        if len(scc) > 1:
+            cycles.append(sorted(scc))
+    return levels, sorted(cycles)
+
+def print_levels(kind, graph):
+    """Print the level numbers of the nodes in `graph` (see
+    `condensed_levels`) and any cycles among them, and return the number of
+    cycles."""
+    levels, cycles = condensed_levels(graph)
+    print(f"{kind} levels:", file=report_file)
+    for level in range(1, max(levels.values(), default=0) + 1):
+        nodes = sorted(node for node in levels if levels[node] == level)
+        print('\n'.join(textwrap.wrap(' '.join(nodes), width=79,
+                                      initial_indent=f"    {level:>3}: ",
+                                      subsequent_indent="         ")),
+              file=report_file)
+    for cycle in cycles:
+        print(f"    Error: {kind} dependency cycle among:", file=report_file)
+        print('\n'.join(textwrap.wrap(' '.join(cycle), width=79,
+                                      initial_indent="        ",
+                                      subsequent_indent="        ")),
+              file=report_file)
+    print(file=report_file)
+    return len(cycles)
+
+def report_package_levels():
+    """Print the package and group levels implied by the (non-test)
+    dependencies among the components and return the number of package and
+    group cycles found"""
+    package_graph = { package: set() for package in sorted(package_dirs) }
+    group_graph   = { group: set() for group in
+                      sorted(set(package_groups.values())) }
+    for component in components.values():
+        for dependency_id in component.component_deps:
+            dependency_package = component_list[dependency_id].package
+            if dependency_package != component.package:
+                package_graph[component.package].add(dependency_package)
+                group            = package_groups[component.package]
+                dependency_group = package_groups[dependency_package]
+                if dependency_group != group:
+                    group_graph[group].add(dependency_group)
+
+    return (print_levels("Package", package_graph) +
+            print_levels("Group", group_graph))
+
+def write_index(file_name):
+    """Write a compact index of the dependency graph to `file_name`.  The
+    index is a pickled dictionary in which each component is identified by
+    its position in the sorted `components` list and the direct
+    dependencies of component `i` are `deps[deps_offsets[i]:
+    deps_offsets[i + 1]]` (similarly for `testonly_deps`).  Levels and
+    error and warning counts are stored as parallel arrays."""
+    names        = sorted(components)
+    index_id     = array('I', bytes(4 * len(component_names)))
+    for i, name in enumerate(names):
+        index_id[component_ids[name]] = i
+    packages     = sorted(set(components[name].package for name in names))
+    package_id   = { package: i for i, package in enumerate(packages) }
+
+    index = {
+        "format"            : index_format,
+        "version"           : index_version,
+        "components"        : names,
+        "packages"          : packages,
+        "component_package" : array('I', (package_id[components[name].package]
+                                          for name in names)),
+        "component_level"   : array('I'),
+        "testonly_level"    : array('I'),
+        "error_count"       : array('I'),
+        "warning_count"     : array('I'),
+        "deps_offsets"      : array('I', [0]),
+        "deps"              : array('I'),
+        "testonly_offsets"  : array('I', [0]),
+        "testonly_deps"     : array('I'),
+    }
+    for name in names:
+        component = visit_by_name(name)
+        index["component_level"].append(component.component_level)
+        index["testonly_level"].append(component.testonly_level)
+        index["error_count"].append(component.error_count)
+        index["warning_count"].append(component.warning_count)
+        index["deps"].extend(sorted(index_id[dependency_id]
+                                    for dependency_id in
+                                    component.component_deps))
+        index["deps_offsets"].append(len(index["deps"]))
+        index["testonly_deps"].extend(sorted(index_id[dependency_id]
+                                             for dependency_id in
+                                             component.testonly_deps))
+        index["testonly_offsets"].append(len(index["testonly_deps"]))
+
+    tmp_file = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, file_name)
+
+def write_jsonl(file):
+    """Write one JSON object per line to `file` for each component, in
+    sorted order, without building the whole document in memory"""
+    for name in sorted(components):
+        component = visit_by_name(name)
+        file.write(json.dumps({
+            "component"      : name,
+            "package"        : component.package,
+            "level"          : component.component_level,
+            "testonly_level" : component.testonly_level,
+            "deps"           : [component_names[dependency_id] for
+                                dependency_id in component.component_deps],
+            "testonly_deps"  : [component_names[dependency_id] for
+                                dependency_id in component.testonly_deps],
+            "errors"         : component.error_count,
+            "warnings"       : component.warning_count,
+        }) + '\n')
+
+def write_outputs(component_map):
+    """Write the `--write-index`, `--jsonl` and `--schedule` outputs, if
+    requested"""
+    if schedule_file is not None:
+        write_schedule(component_map)
+    if index_file is not None:
+        write_index(index_file)
+    if jsonl_file == '-':
+        write_jsonl(sys.stdout)
+    elif jsonl_file is not None:
+        with open(jsonl_file, 'w') as file:
+            write_jsonl(file)
+
+def report_components(component_names):
+    """Visit each of the specified `component_names`, print the report for
+    each one that has errors or warnings (or for all of them in verbose
+    mode), and return the tuple `(error_count, warning_count)`"""
+    total_error_count   = 0
+    total_warning_count = 0
+    for component_name in component_names:
+        component = visit_by_name(component_name)
+        total_error_count   += component.error_count
+        total_warning_count += component.warning_count
+        if verbose or component.error_count > 0 or component.warning_count > 0:
+            print(component, file=report_file)
+    return total_error_count, total_warning_count
+
+class reachability_index:
+    """Transitive closure of the (non-test) dependencies among the
+    components, built once and saved in the cache directory.  The graph is
+    condensed into its strongly-connected components, numbered so that each
+    one comes after everything it depends on, and the set of nodes each one
+    depends on is stored as an `int` bitset, so that `depends` is a single
+    bit test.  Dependents are found by a search of the reversed condensed
+    graph, which is also stored.  The index is reloaded only if the `.h` and
+    `.cpp` files of its components and their directories have the same sizes
+    and modification times as when it was built."""
+
+    def __init__(self, key):
+        self.key      = key
+        self.names    = []    # Component names, in sorted order
+        self.number   = { }   # Map component name to position in `names`
+        self.scc      = array('I')  # Condensed node of each component
+        self.members  = []    # Components of each condensed node
+        self.down     = []    # Bitset of the nodes each node depends on
+        self.up_offsets = array('I', [0])
+        self.up       = array('I')  # Direct dependents of each node, in
+                                    # `up[up_offsets[i]:up_offsets[i + 1]]`
+        self.sources  = { }   # Map path to `(size, mtime_ns)`
+        self.index_file = os.path.join(
+            cache_dir, "reachability-" +
+            hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest() +
+            ".pickle")
+
+    def build(self):
+        """Build the index from the direct dependencies in `components`"""
+        self.names  = sorted(components)
+        self.number = { name: i for i, name in enumerate(self.names) }
+        graph = [[self.number[component_names[dependency_id]]
+                  for dependency_id in components[name].component_deps]
+                 for name in self.names]
+        sccs = strongly_connected(range(len(graph)), graph.__getitem__)
+
+        # Tarjan's algorithm yields each node after the ones it depends on
+        self.scc = array('I', bytes(4 * len(graph)))
+        for node, scc in enumerate(sccs):
+            for component in scc:
+                self.scc[component] = node
+        self.members = [array('I', sorted(scc)) for scc in sccs]
+        self.down    = []
+        up           = [set() for scc in sccs]
+        for node, scc in enumerate(sccs):
+            bits = 1 << node
+            for component in scc:
+                for dependency in graph[component]:
+                    dependency_node = self.scc[dependency]
+                    if dependency_node != node:
+                        bits |= self.down[dependency_node]
+                        up[dependency_node].add(node)
+            self.down.append(bits)
+        self.up_offsets = array('I', [0])
+        self.up         = array('I')
+        for dependents in up:
+            self.up.extend(sorted(dependents))
+            self.up_offsets.append(len(self.up))
+
+        self.sources = { }
+        for name in self.names:
+            component = components[name]
+            self.sources.setdefault(component.directory, None)
+            for file_name in component.files()[:2]:
+                self.sources[os.path.join(component.directory,
+                                          file_name)] = None
+        for path in self.sources:
+            self.sources[path] = self.signature(path)
+
+    @staticmethod
+    def signature(path):
+        """Return the `(size, mtime_ns)` pair for `path`, or `None` if it
+        does not exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        """Replace this index with the saved one and return true if it is
+        still up to date, or return false otherwise"""
+        try:
+            with open(self.index_file, 'rb') as file:
+                version, key, state = pickle.load(file)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False  # Missing or corrupt index
+        if version != reachability_version or key != self.key:
+            return False
+        for path, signature in state["sources"].items():
+            counters["files stat'ed"] += 1
+            if self.signature(path) != signature:
+                return False
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+        self.number = { name: i for i, name in enumerate(self.names) }
+        return True
+
+    def save(self):
+        if not use_cache:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        state = { attribute: getattr(self, attribute) for attribute in
+                  ("names", "scc", "members", "down", "up_offsets", "up",
+                   "sources") }
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as file:
+            pickle.dump((reachability_version, self.key, state), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+
+    def expand(self, nodes, exclude):
+        """Return the sorted names of the components of the condensed
+        `nodes`, other than `exclude`"""
+        return sorted(self.names[component] for node in nodes
+                      for component in self.members[node]
+                      if self.names[component] != exclude)
+
+    def depends(self, name, dependency_name):
+        """Return true if component `name` depends, directly or indirectly,
+        on component `dependency_name`.  A component depends on itself only
+        if it is part of a cycle."""
+        if name == dependency_name:
+            return len(self.members[self.scc[self.number[name]]]) > 1
+        return bool(self.down[self.scc[self.number[name]]] >>
+                    self.scc[self.number[dependency_name]] & 1)
+
+    def dependencies(self, name):
+        """Return the sorted names of the components `name` depends on,
+        directly or indirectly"""
+        bits = bin(self.down[self.scc[self.number[name]]])[:1:-1]
+        return self.expand((node for node, bit in enumerate(bits)
+                            if bit == '1'), name)
+
+    def dependents(self, name):
+        """Return the sorted names of the components that depend on `name`,
+        directly or indirectly"""
+        start = self.scc[self.number[name]]
+        found = { start }
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for dependent in self.up[self.up_offsets[node]:
+                                     self.up_offsets[node + 1]]:
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        return self.expand(found, name)
+
+def get_reachability_index(component_map):
+    """Return an up-to-date `reachability_index` for the components in
+    `component_map`, loading it from the cache directory if possible and
+    otherwise scanning the components and building (and saving) it"""
+    key = (os.path.abspath(repo_dir) if repo_dir is not None else None,
+           preamble_only,
+           sorted(os.path.abspath(path) for path in component_map.values()))
+    index = reachability_index(key)
+    if use_cache:
+        with profile_phase("load"):
+            if index.load():
+                return index
+    with profile_phase("scan"):
+        scan_components(component_map)
+    with profile_phase("index"):
+        index.build()
+        index.save()
+    return index
+
+def answer_queries(index):
+    """Print the answer to each of the `queries` using `index`, and return
+    the exit status: 2 if a component is unknown, 1 if any `--depends`
+    query is false, and 0 otherwise"""
+    for query, *names in queries:
+        for name in names:
+            if name not in index.number:
+                print(f"{progname}: unknown component: {name}",
+                      file=sys.stderr)
+                return 2
+    status = 0
+    for query, *names in queries:
+        if query == "depends":
+            if index.depends(*names):
+                print(f"{names[0]} depends on {names[1]}")
+            else:
+                print(f"{names[0]} does not depend on {names[1]}")
+                status = 1
+        else:
+            found = getattr(index, query)(names[0])
+            print(f"{names[0]} has {len(found)} {query}" +
+                  (":" if found else ""))
+            for name in found:
+                print(f"    {name}")
+    return status
+
+def git_changed_files(revision_range):
+    """Return the paths of the files changed in `revision_range`, as
+    understood by `git diff`, or `None` if `git` fails"""
+    try:
+        top = subprocess.run(["git", "rev-parse", "--show-toplevel"],
+                             capture_output=True, text=True, check=True)
+        diff = subprocess.run(["git", "diff", "--name-only", revision_range,
+                               "--"],
+                              capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        error = getattr(e, "stderr", None) or str(e)
+        print(f"{progname}: git: {error.strip()}", file=sys.stderr)
+        return None
+    return [os.path.join(top.stdout.strip(), path)
+            for path in diff.stdout.splitlines() if path]
+
+def changed_components(paths):
+    """Return the tuple `(interface_changes, test_changes)` of the sets of
+    names of the scanned components whose header or implementation file,
+    or whose test driver, respectively, is one of `paths`"""
+    interface_changes = set()
+    test_changes      = set()
+    for path in paths:
+        match = component_file_re.match(os.path.basename(path))
+        if not match or match[1] not in components:
+            continue
+        component = components[match[1]]
+        if (os.path.realpath(os.path.dirname(path) or '.') !=
+            os.path.realpath(component.directory or '.')):
+            continue  # Same name in another directory
+        if match[2] in ("h", "cpp"):
+            interface_changes.add(component.component_name)
+        else:
+            test_changes.add(component.component_name)
+    return interface_changes, test_changes
+
+def reverse_dependencies():
+    """Return the tuple `(dependents, testonly_dependents)` of maps from
+    each component name to the set of names of the components that depend
+    on it directly, through non-test and test-only dependencies
+    respectively"""
+    dependents          = { }
+    testonly_dependents = { }
+    for name, component in components.items():
+        for dependency_id in component.component_deps:
+            dependents.setdefault(component_names[dependency_id],
+                                  set()).add(name)
+        for dependency_id in component.testonly_deps:
+            testonly_dependents.setdefault(component_names[dependency_id],
+                                           set()).add(name)
+    return dependents, testonly_dependents
+
+def affected_components(paths):
+    """Return the set of names of the components whose test drivers must be
+    rebuilt and re-run after the files in `paths` change.  A change to the
+    header or implementation of a component affects it, every component
+    that depends on it, and every component whose test driver depends on
+    one of those; a change to a test driver affects only its component."""
+    interface_changes, test_changes = changed_components(paths)
+    dependents, testonly_dependents = reverse_dependencies()
+
+    affected = set(interface_changes)
+    stack    = list(interface_changes)
+    while stack:
+        for dependent in dependents.get(stack.pop(), ()):
+            if dependent not in affected:
+                affected.add(dependent)
+                stack.append(dependent)
+    for name in list(affected):
+        affected.update(testonly_dependents.get(name, ()))
+    return affected | test_changes
+
+def report_impact(paths):
+    """Print the test drivers of the components affected by changes to the
+    files in `paths`, one per line, lowest level first, and a summary to
+    `stderr`"""
+    affected = affected_components(paths)
+    for name in affected:
+        visit_by_name(name)
+    num_drivers = 0
+    for name in sorted(affected, key=lambda name:
+                       (components[name].testonly_level, name)):
+        for driver in components[name].test_drivers():
+            print(driver)
+            num_drivers += 1
+    print(f"{len(affected)} of {len(components)} components affected, " +
+          f"{num_drivers} test drivers", file=sys.stderr)
+
+def read_durations(file_name):
+    """Return a map from each test-driver file name or component name in
+    `file_name` to its duration in seconds.  Each line of the file is
+    `<name> <seconds>`, where a name with a directory is reduced to its last
+    component; blank lines and `#` comments are ignored."""
+    durations = { }
+    with open(file_name, 'r') as file:
+        for line_num, line in enumerate(file, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                name, seconds = fields
+                durations[os.path.basename(name)] = float(seconds)
+            except ValueError:
+                raise ValueError(f"{file_name}:{line_num}: expected " +
+                                 "<name> <seconds>") from None
+    return durations
+
+class test_schedule:
+    """Plan for compiling and running the test drivers of a set of
+    components on many cores.  Each test driver is a job, and the jobs of a
+    component start only once the jobs of every scheduled component on
+    which it depends, directly or through unscheduled components, are done
+    (dependencies within a cycle are ignored).  The components are grouped
+    into waves, numbered from 1, so that each component depends only on
+    components of earlier waves.  Each job is weighted by its historical
+    duration in seconds, when `durations` are given, or else by the size of
+    the test driver and of the component's header and implementation.  The
+    priority of a job is the weight of the longest chain of jobs that it
+    starts, the longest such chain being the critical path; starting jobs in
+    priority order keeps the cores busy."""
+
+    def __init__(self, component_names, durations):
+        self.names = sorted(component_names,
+                            key=lambda name: (components[name].testonly_level,
+                                              name))
+        scheduled  = set(self.names)
+
+        # Nearest scheduled dependencies of every component, following only
+        # edges to lower levels, which excludes edges within cycles
+        self.deps = { }
+        for name in sorted(components, key=lambda name:
+                           components[name].testonly_level):
+            component = components[name]
+            deps      = set()
+            for dependency, testdep in component.dependencies():
+                if dependency.testonly_level >= component.testonly_level:
+                    continue
+                if dependency.component_name in scheduled:
+                    deps.add(dependency.component_name)
+                else:
+                    deps.update(self.deps[dependency.component_name])
+            self.deps[name] = deps
+
+        self.drivers = { }  # Map name to list of `(weight, driver)`
+        sizes        = { }  # Map driver to size-based weight
+        for name in self.names:
+            component = components[name]
+            common    = sum(file_size(os.path.join(component.directory,
+                                                   file_name))
+                            for file_name in component.files()[:2])
+            drivers   = component.test_drivers()
+            for driver in drivers:
+                sizes[driver] = common + file_size(driver)
+            self.drivers[name] = [(sizes[driver], driver)
+                                  for driver in drivers]
+
+        # Known durations, and a seconds-per-byte scale for the rest
+        known = { }
+        for name in self.names:
+            drivers = self.drivers[name]
+            for weight, driver in drivers:
+                if os.path.basename(driver) in durations:
+                    known[driver] = durations[os.path.basename(driver)]
+                elif name in durations:
+                    known[driver] = durations[name] / len(drivers)
+        self.seconds = bool(known)
+        if known:
+            known_size = sum(sizes[driver] for driver in known)
+            scale      = sum(known.values()) / max(known_size, 1)
+            for name in self.names:
+                self.drivers[name] = [(known.get(driver, weight * scale),
+                                       driver)
+                                      for weight, driver in
+                                      self.drivers[name]]
+        for name in self.names:
+            self.drivers[name].sort(key=lambda job: (-job[0], job[1]))
+
+        # Waves and the longest chain ending with each component, in
+        # dependency order
+        self.wave   = { }
+        finish      = { }
+        previous    = { }
+        self.total  = 0
+        for name in self.names:
+            span = max((weight for weight, driver in self.drivers[name]),
+                       default=0)
+            self.total += sum(weight for weight, driver in
+                              self.drivers[name])
+            self.wave[name] = 1 + max((self.wave[dep] for dep in
+                                       self.deps[name]), default=0)
+            previous[name]  = max(sorted(self.deps[name]), default=None,
+                                  key=lambda dep: finish[dep])
+            finish[name]    = span + (finish[previous[name]]
+                                      if previous[name] else 0)
+
+        # Longest chain starting with each component, in reverse order
+        self.tail = { }
+        dependents = { name: [] for name in self.names }
+        for name in self.names:
+            for dep in self.deps[name]:
+                dependents[dep].append(name)
+        for name in reversed(self.names):
+            span = max((weight for weight, driver in self.drivers[name]),
+                       default=0)
+            self.tail[name] = span + max((self.tail[dependent] for dependent
+                                          in dependents[name]), default=0)
+
+        self.critical_path = []
+        name = max(sorted(self.names), default=None,
+                   key=lambda name: finish[name])
+        while name is not None:
+            self.critical_path.append(name)
+            name = previous[name]
+        self.critical_path.reverse()
+        self.length = finish[self.critical_path[-1]] \
+            if self.critical_path else 0
+
+        self.order = sorted(self.names, key=lambda name:
+                            (self.wave[name], -self.tail[name], name))
+
+    def jobs(self):
+        """Generate a `(wave, priority, component-name, driver)` tuple for
+        each job, in the order in which the jobs should be started"""
+        for name in self.order:
+            span = max((weight for weight, driver in self.drivers[name]),
+                       default=0)
+            for weight, driver in self.drivers[name]:
+                yield (self.wave[name], self.tail[name] - span + weight,
+                       name, driver)
+
+    def format_weight(self, weight):
+        if self.seconds:
+            return f"{weight:.1f} s"
+        if weight < 1e6:
+            return f"{weight / 1e3:.1f} kB"
+        return f"{weight / 1e6:.1f} MB"
+
+    def write_list(self, file):
+        """Write one line per job, `<wave> <priority> <test-driver>`,
+        separated by tabs, in the order in which the jobs should be
+        started"""
+        for wave, priority, name, driver in self.jobs():
+            priority = f"{priority:.3f}" if self.seconds else priority
+            file.write(f"{wave}\t{priority}\t{driver}\n")
+
+    def header(self):
+        return (f"# Test-driver schedule written by {progname}: " +
+                f"{len(self.names)} components,\n# " +
+                f"{sum(map(len, self.drivers.values()))} test drivers " +
+                f"in {max(self.wave.values(), default=0)} waves, total " +
+                f"{self.format_weight(self.total)}, critical path " +
+                f"{self.format_weight(self.length)}\n")
+
+    def write_make(self, file):
+        """Write a Makefile fragment with a phony target for each job,
+        `depcheck.<test-driver>`, and for each component,
+        `depcheck.<component>`, and a `depcheck-all` target listing the
+        components in priority order.  Each job runs
+        `$(DEPCHECK_RUN) <test-driver>`."""
+        file.write(self.header())
+        file.write("# Set DEPCHECK_RUN to a command that builds and runs " +
+                   "the test driver\n# it is given.\nDEPCHECK_RUN ?= echo\n\n")
+        file.write(".PHONY: depcheck-all\n" +
+                   wrap_words("depcheck-all:", [f"depcheck.{name}"
+                                                for name in self.order],
+                              " \\") + "\n")
+        for name in self.order:
+            deps    = ''.join(f" depcheck.{dep}"
+                              for dep in sorted(self.deps[name]))
+            drivers = [driver for weight, driver in self.drivers[name]]
+            targets = [f"depcheck.{os.path.basename(driver)}"
+                       for driver in drivers]
+            file.write(f"\n.PHONY: depcheck.{name} {' '.join(targets)}\n")
+            file.write(f"depcheck.{name}: {' '.join(targets)}" +
+                       (f" |{deps}" if deps else "") + "\n")
+            for target, driver in zip(targets, drivers):
+                file.write(f"{target}:" + (f" |{deps}" if deps else "") +
+                           f"\n\t$(DEPCHECK_RUN) {driver}\n")
+
+    def write_ninja(self, file):
+        """Write a ninja fragment with the same targets as `write_make`,
+        where each job runs `$depcheck_run <test-driver>`"""
+        def escape(path):
+            return re.sub(r"([$ :])", r"$\1", path)
+        file.write(self.header())
+        file.write("# Set depcheck_run to a command that builds and runs " +
+                   "the test driver\n# it is given.\ndepcheck_run = echo\n\n" +
+                   "rule depcheck_run\n  command = $depcheck_run $in\n" +
+                   "  description = TEST $in\n")
+        for name in self.order:
+            deps    = ''.join(f" depcheck.{dep}"
+                              for dep in sorted(self.deps[name]))
+            deps    = f" ||{deps}" if deps else ""
+            targets = []
+            file.write("\n")
+            for weight, driver in self.drivers[name]:
+                target = f"depcheck.{escape(os.path.basename(driver))}"
+                targets.append(target)
+                file.write(f"build {target}: depcheck_run {escape(driver)}" +
+                           f"{deps}\n")
+            file.write(f"build depcheck.{name}: phony {' '.join(targets)}" +
+                       f"{deps}\n")
+        file.write("\n" +
+                   wrap_words("build depcheck-all: phony",
+                              [f"depcheck.{name}" for name in self.order],
+                              " $") + "\ndefault depcheck-all\n")
+
+    def print_summary(self, file = sys.stderr):
+        print(self.header().replace("# ", "").replace("\n", " ").strip(),
+              file=file)
+        if self.critical_path:
+            print('\n'.join(textwrap.wrap(' -> '.join(self.critical_path),
+                                          width=79,
+                                          initial_indent="    Critical: ",
+                                          subsequent_indent="        ",
+                                          break_long_words=False)),
+                  file=file)
+
+def wrap_words(first, words, continuation):
+    """Return `first` followed by `words`, separated by spaces and broken
+    into lines of at most 79 columns ending with `continuation`"""
+    lines = textwrap.wrap(' '.join([first] + words), width=79 - len(
+        continuation), subsequent_indent="    ", break_long_words=False,
+                          break_on_hyphens=False)
+    return (continuation + '\n').join(lines)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def write_schedule(component_names):
+    """Write the `--schedule` output for the components named by
+    `component_names` in `schedule_format`, and a summary to `stderr`"""
+    schedule = test_schedule(component_names, durations)
+    writer   = getattr(schedule, f"write_{schedule_format}")
+    if schedule_file == '-':
+        writer(sys.stdout)
+    else:
+        with open(schedule_file, 'w') as file:
+            writer(file)
+    schedule.print_summary()
+
+class git_object_reader:
+    """A long-lived `git cat-file --batch` process reading objects from the
+    repository containing the current directory.  The requests for a batch
+    of objects are written by a separate thread while the replies are read,
+    so that neither pipe can fill up and stall the other."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def read_objects(self, names):
+        """Return a list with a `(type, oid, content)` tuple for each object
+        in `names` (anything `git rev-parse` accepts, e.g., an object ID or
+        `<tree>:<path>`), or `None` for a name that does not exist"""
+        names = list(names)
+
+        def write_requests():
+            try:
+                for name in names:
+                    self.process.stdin.write(name.encode() + b"\n")
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                pass  # Reported by the reader
+
+        writer = threading.Thread(target=write_requests, daemon=True)
+        writer.start()
+        ret = []
+        for name in names:
+            header = self.process.stdout.readline()
+            if not header:
+                raise OSError("git cat-file exited unexpectedly")
+            if header.endswith((b" missing\n", b" ambiguous\n")):
+                ret.append(None)
+                continue
+            oid, kind, size = header.split()
+            content = self.process.stdout.read(int(size) + 1)[:-1]
+            counters["objects read"] += 1
+            ret.append((kind.decode(), oid.decode(), content))
+        writer.join()
+        return ret
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def parse_tree(content, oid_size):
+    """Return a map from the name of each entry in the raw git tree object
+    `content` to the pair `(is-directory, oid)`"""
+    entries = { }
+    pos     = 0
+    while pos < len(content):
+        nul        = content.index(b"\0", pos)
+        mode, name = content[pos:nul].split(b" ", 1)
+        end        = nul + 1 + oid_size
+        entries[os.fsdecode(name)] = (mode == b"40000",
+                                      content[nul + 1:end].hex())
+        pos = end
+    return entries
+
+class revision_tree:
+    """The directories of one revision, read on demand from the object
+    store.  Directories are named as on the command line, i.e., relative to
+    the current directory, which must be in the working tree."""
+
+    def __init__(self, reader, top, revision):
+        self.reader   = reader
+        self.top      = top
+        self.revision = revision
+        self.trees    = { }  # Map directory to `parse_tree` result or None
+        result = reader.read_objects([revision + "^{tree}"])[0]
+        if result is None:
+            raise ValueError(f"unknown revision {revision}")
+        self.oid = result[1]
+
+    def object_name(self, directory):
+        """Return the name of `directory` in the object store, or `None` if
+        it is outside the working tree"""
+        path = os.path.relpath(os.path.realpath(directory or '.'), self.top)
+        if path == os.curdir:
+            return self.oid
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            return None
+        return f"{self.oid}:{path}"
+
+    def load(self, directories):
+        """Read the trees of those of `directories` not already read, as a
+        single batch"""
+        todo    = [directory for directory in dict.fromkeys(directories)
+                   if directory not in self.trees]
+        names   = [self.object_name(directory) for directory in todo]
+        results = iter(self.reader.read_objects(name for name in names
+                                                if name is not None))
+        for directory, name in zip(todo, names):
+            result = next(results) if name is not None else None
+            self.trees[directory] = None
+            if result is not None and result[0] == "tree":
+                self.trees[directory] = parse_tree(result[2],
+                                                   len(result[1]) // 2)
+
+    def entries(self, directory):
+        """Return the `parse_tree` result for `directory`, or `None` if it
+        is not a directory in this revision"""
+        self.load([directory])
+        return self.trees[directory]
+
+    def subdirectories(self, directory):
+        return sorted(os.path.join(directory, name) for name, (is_dir, oid)
+                      in (self.entries(directory) or { }).items()
+                      if is_dir and not name.startswith('.'))
+
+    def mem_files(self, package_paths):
+        """Return a map from each of `package_paths` to the list of the
+        contents of the `.mem` files in its `package` subdirectory"""
+        self.load(os.path.join(path, "package") for path in package_paths)
+        oids = [(path, oid) for path in package_paths
+                for name, (is_dir, oid) in sorted(
+                    (self.trees[os.path.join(path, "package")] or
+                     { }).items())
+                if name.endswith(".mem") and not is_dir and
+                not name.startswith('.')]
+        ret = { path: [] for path in package_paths }
+        for (path, oid), result in zip(oids, self.reader.read_objects(
+                oid for path, oid in oids)):
+            ret[path].append(result[2].decode(errors='replace'))
+        return ret
+
+    def discover_repo(self, root):
+        """Return the result of `discover_repo(root)` for this revision"""
+        if (self.entries(root) or { }).get("groups", (False,))[0]:
+            root = os.path.join(root, "groups")
+        groups = self.subdirectories(root)
+        self.load(groups)
+        package_paths = [path for group in groups
+                         for path in self.subdirectories(group)]
+        ret = []
+        for package_path, mem_files in self.mem_files(package_paths).items():
+            package = os.path.basename(package_path)
+            if not mem_files:
+                continue
+            package_dirs[package]   = package_path
+            package_groups[package] = \
+                os.path.basename(os.path.dirname(package_path))
+            for mem_file_content in mem_files:
+                for component_name in parse_mem_file(mem_file_content):
+                    component_packages[component_name] = package
+                    ret.append(os.path.join(package_path, component_name))
+        return ret
+
+    def expand_args(self, cpt_args):
+        """Return the component paths named by the component and package
+        `cpt_args` in this revision, as `process_args` does for the working
+        tree, or `None` if a package does not have exactly one `.mem`
+        file"""
+        self.load(cpt_args)
+        packages  = [arg for arg in cpt_args if self.trees[arg] is not None]
+        mem_files = self.mem_files(packages)
+        ret = []
+        for arg in cpt_args:
+            if arg not in mem_files:
+                ret.append(arg)
+            elif len(mem_files[arg]) != 1:
+                print(f"{progname}: {self.revision}: {arg} is not a package",
+                      file=sys.stderr)
+                return None
+            else:
+                ret += [os.path.join(arg, name) for name in
+                        parse_mem_file(mem_files[arg][0])]
+        return ret
+
+class blob_includes:
+    """Persistent map from git blob ID to the includes parsed from the blob.
+    Blobs never change, so an entry is always valid: a file that is the same
+    in both revisions, or that was scanned by an earlier run, is neither
+    read nor parsed again.  Only the entries used by a run are saved, which
+    keeps the cache to the size of the trees compared."""
+
+    def __init__(self, reader):
+        self.reader     = reader
+        self.cache_file = os.path.join(
+            cache_dir,
+            "git-blobs" + ("-preamble" if preamble_only else "") + ".pickle")
+        self.entries = { }
+        self.used    = { }
+        self.pending = { }  # Map key to `(oid, file_name)` still to be read
+        if not use_cache:
+            return
+        try:
+            with open(self.cache_file, 'rb') as file:
+                version, entries = pickle.load(file)
+            if version == cache_version:
+                self.entries = entries
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass  # Missing or corrupt cache; start over
+
+    @staticmethod
+    def key(oid, file_name):
+        # With `--preamble`, a header is scanned differently from other files
+        if preamble_only and file_name.endswith(".h"):
+            return oid + ".h"
+        return oid
+
+    def request(self, oid, file_name):
+        """Arrange for the includes of the blob `oid`, the content of
+        `file_name`, to be available to `includes`"""
+        key = self.key(oid, file_name)
+        if key in self.used:
+            return
+        if key in self.entries:
+            self.used[key] = self.entries[key]
+        else:
+            self.pending[key] = (oid, file_name)
+
+    def read_pending(self):
+        """Read and parse the requested blobs that were not cached, as a
+        single batch"""
+        pending      = list(self.pending.items())
+        self.pending = { }
+        results = self.reader.read_objects(oid for key, (oid, file_name)
+                                           in pending)
+        for (key, (oid, file_name)), result in zip(pending, results):
+            digest, includes = scan_content(result[2], file_name,
+                                            preamble_only)
+            counters["files read"]      += 1
+            counters["bytes read"]      += len(result[2])
+            counters["include matches"] += len(includes)
+            self.used[key] = tuple(include_pairs.setdefault(pair, pair)
+                                   for pair in includes)
+
+    def includes(self, oid, file_name):
+        key = self.key(oid, file_name)
+        if key not in self.used:
+            self.request(oid, file_name)
+        if self.pending:
+            self.read_pending()
+        return self.used[key]
+
+    def save(self):
+        if not use_cache or self.used == self.entries:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as file:
+            pickle.dump((cache_version, self.used), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+
+class revision_include_cache:
+    """Stand-in for the `include_cache` of one package directory that
+    supplies the includes of the files in a `revision_tree`.  The blobs of
+    a whole wave of components are requested by `stale_files` and read
+    together by the first call to `includes`."""
+
+    def __init__(self, directory, entries, blobs):
+        self.directory = directory
+        self.entries   = entries or { }
+        self.blobs     = blobs
+
+    def stale_files(self, file_names):
+        for file_name in file_names:
+            if file_name in self.entries:
+                self.blobs.request(self.entries[file_name][1], file_name)
+        return []  # Nothing to read from the working tree
+
+    def includes(self, file_name):
+        if file_name not in self.entries:
+            return ()
+        return self.blobs.includes(self.entries[file_name][1], file_name)
+
+    def save(self):
+        pass
+
+def reset_graph():
+    """Forget all components, packages and directories, so that another
+    revision can be analyzed.  Component IDs are kept, so that dependencies
+    and cycles can be compared across revisions."""
+    reset_components()
+    for table in (component_packages, package_dirs, package_groups,
+                  include_caches, directory_indexes):
+        table.clear()
+
+class graph_snapshot:
+    """The levels, test-only dependencies and cycles of the components of
+    one revision.  Cycles are kept as edge tuples rotated to start at the
+    smallest edge, so that a cycle compares equal whichever component it is
+    recorded in."""
+
+    def __init__(self, names):
+        self.levels          = { }  # Map name to `(level, test-driver level)`
+        self.testonly_deps   = { }  # Map name to set of names
+        self.cycles          = set()
+        self.testonly_cycles = set()
+        for name in names:
+            component = visit_by_name(name)
+            self.levels[name] = (component.component_level,
+                                 component.testonly_level)
+            self.testonly_deps[name] = set(component_names[dependency_id]
+                                           for dependency_id in
+                                           component.testonly_deps)
+        for component in components.values():
+            for cycles, snapshot_cycles in (
+                    (component.component_cycles, self.cycles),
+                    (component.testonly_cycles, self.testonly_cycles)):
+                for cycle in cycles or ():
+                    snapshot_cycles.add(min(cycle[i:] + cycle[:i]
+                                            for i in range(len(cycle))))
+
+def analyze_revision(tree, blobs, cpt_args):
+    """Scan and traverse the components named by `cpt_args` (or found under
+    `repo_dir`) in the `revision_tree` `tree`, and return their
+    `graph_snapshot`, or `None` if the arguments are invalid"""
+    reset_graph()
+    if repo_dir is not None:
+        paths = tree.discover_repo(repo_dir)
+    else:
+        paths = tree.expand_args(cpt_args)
+        if paths is None:
+            return None
+    component_map = make_component_map(paths)
+    directories   = set(package_dirs.values())
+    tree.load(directories)
+    for directory in directories:
+        entries = tree.trees[directory] or { }
+        directory_indexes[directory] = index_file_names(
+            name for name, (is_dir, oid) in entries.items() if not is_dir)
+        include_caches[directory] = \
+            revision_include_cache(directory, entries, blobs)
+    scan_components(component_map)
+    return graph_snapshot(sorted(component_map))
+
+def print_section(title, lines):
+    if lines:
+        print(f"{title}:")
+        for line in lines:
+            print(line)
+
+def report_revision_diff(old, new):
+    """Print the differences between the `graph_snapshot`s of the two
+    `revisions` and return the number of dependency cycles introduced"""
+    print(f"Dependency changes from {revisions[0]} to {revisions[1]}:")
+    common = sorted(old.levels.keys() & new.levels.keys())
+    print_section("Components added",
+                  [f"    {name}: level {new.levels[name][0]}"
+                   for name in sorted(new.levels.keys() - old.levels.keys())])
+    print_section("Components removed",
+                  [f"    {name}"
+                   for name in sorted(old.levels.keys() - new.levels.keys())])
+
+    level_changes = []
+    for name in common:
+        (old_level, old_test_level), (new_level, new_test_level) = \
+            old.levels[name], new.levels[name]
+        changes = []
+        if old_level != new_level:
+            changes.append(f"level {old_level} -> {new_level}")
+        if old_test_level != new_test_level:
+            changes.append(f"test-driver level {old_test_level} -> " +
+                           f"{new_test_level}")
+        if changes:
+            level_changes.append(f"    {name}: " + ", ".join(changes))
+    print_section("Level changes", level_changes)
+
+    for title, old_cycles, new_cycles in (
+            ("dependency cycles", old.cycles, new.cycles),
+            ("test-only dependency cycles", old.testonly_cycles,
+             new.testonly_cycles)):
+        for kind, cycles in (("New", new_cycles - old_cycles),
+                             ("Removed", old_cycles - new_cycles)):
+            print_section(f"{kind} {title}",
+                          [component_stats.format_cycle(cycle) for cycle in
+                           sorted(cycles, key=cycle_key)])
+
+    testonly_changes = []
+    for name in common:
+        added   = new.testonly_deps[name] - old.testonly_deps[name]
+        removed = old.testonly_deps[name] - new.testonly_deps[name]
+        if added or removed:
+            testonly_changes.append('\n'.join(textwrap.wrap(
+                f"{name}: " + ' '.join(["+" + dep for dep in sorted(added)] +
+                                       ["-" + dep for dep in sorted(removed)]),
+                width=79, initial_indent="    ", subsequent_indent="        ",
+                break_long_words=False, break_on_hyphens=False)))
+    print_section("Test-only dependency changes", testonly_changes)
+
+    if (old.levels == new.levels and old.cycles == new.cycles and
+        old.testonly_cycles == new.testonly_cycles and
+        old.testonly_deps == new.testonly_deps):
+        print("    No changes")
+    return len(new.cycles - old.cycles)
+
+def diff_revisions(cpt_args):
+    """Compare the dependency graphs of the two `revisions`, reading the
+    files of both from the object store, and return the exit status: 1 if
+    the second revision introduces a dependency cycle, 2 on error, and 0
+    otherwise"""
+    try:
+        top = subprocess.run(["git", "rev-parse", "--show-toplevel"],
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        error = getattr(e, "stderr", None) or str(e)
+        print(f"{progname}: git: {error.strip()}", file=sys.stderr)
+        return 2
+    reader = git_object_reader()
+    try:
+        blobs     = blob_includes(reader)
+        snapshots = []
+        try:
+            for revision in revisions:
+                with profile_phase(revision):
+                    snapshot = analyze_revision(
+                        revision_tree(reader, top.stdout.strip(), revision),
+                        blobs, cpt_args)
+                if snapshot is None:
+                    return 2
+                snapshots.append(snapshot)
+        finally:
+            # Keep the blobs parsed so far even if a revision failed
+            with profile_phase("save"):
+                blobs.save()
+    except (OSError, ValueError) as e:
+        print(f"{progname}: {e}", file=sys.stderr)
+        return 2
+    finally:
+        reader.close()
+    with profile_phase("report"):
+        new_cycles = report_revision_diff(*snapshots)
+    return 1 if new_cycles else 0
+
+class inotify_watcher:
+    """Wait for changes to files in a set of directories using Linux
+    `inotify`.  Construction raises `OSError` if `inotify` is unavailable."""
+
+    # From <sys/inotify.h>
+    IN_MODIFY      = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM  = 0x040
+    IN_MOVED_TO    = 0x080
+    IN_CREATE      = 0x100
+    IN_DELETE      = 0x200
+    event_header   = struct.Struct("iIII")
+
+    def __init__(self, directories):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                self.IN_CREATE | self.IN_DELETE | self.IN_MODIFY)
+        self.directories = { }  # Map watch descriptor to directory
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd,
+                                        os.fsencode(directory or '.'), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(),
+                              f"Cannot watch {directory}")
+            self.directories[wd] = directory
+
+    def wait(self):
+        """Block until at least one file changes, then return a map from
+        directory to the set of names of changed files in that directory.
+        Events arriving within a few milliseconds of the first are returned
+        together, since editors often save a file in several steps."""
+        changed = { }
+        timeout = None
+        while select.select([self.fd], [], [], timeout)[0]:
+            buffer = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = \
+                    self.event_header.unpack_from(buffer, offset)
+                offset += self.event_header.size
+                name    = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if wd in self.directories and name:
+                    changed.setdefault(self.directories[wd],
+                                       set()).add(os.fsdecode(name))
+            timeout = 0.02
+        return changed
+
+class polling_watcher:
+    """Wait for changes to files in a set of directories by periodically
+    comparing the size and modification time of every file"""
+
+    def __init__(self, directories, interval = 0.25):
+        self.interval  = interval
+        self.snapshots = { directory: self.snapshot(directory)
+                           for directory in directories }
+
+    @staticmethod
+    def snapshot(directory):
+        ret = { }
+        with os.scandir(directory or '.') as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    ret[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    pass  # Deleted while scanning
+        return ret
+
+    def wait(self):
+        """Block until at least one file changes, then return a map from
+        directory to the set of names of changed files in that directory"""
+        while True:
+            time.sleep(self.interval)
+            changed = { }
+            for directory, old_snapshot in self.snapshots.items():
+                new_snapshot = self.snapshot(directory)
+                names = set(name for name in old_snapshot.keys() |
+                            new_snapshot.keys()
+                            if old_snapshot.get(name) !=
+                               new_snapshot.get(name))
+                if names:
+                    changed[directory] = names
+                self.snapshots[directory] = new_snapshot
+            if changed:
+                return changed
+
+def build_dependents():
+    """Return a map from each component name to the set of components that
+    depend on it directly (including test-only dependencies)"""
+    dependents = { }
+    for component in components.values():
+        for dependency_name in component.dependency_names():
+            dependents.setdefault(dependency_name, set()).add(component)
+    return dependents
+
+def reset_components():
+    """Forget every component, so that the graph can be built again.
+    Component IDs are kept."""
+    global dfs_counter
+    components.clear()
+    component_list[:] = repeat(None, len(component_list))
+    dfs_counter = 0
+
+def rebuild_graph(component_map):
+    """Build the graph for `component_map` again from scratch, re-parsing
+    only the files that the include caches show to have changed, and return
+    the set of all components.  Used when an incremental update fails
+    partway, leaving the graph inconsistent."""
+    reset_components()
+    directory_indexes.clear()
+    for cache in include_caches.values():
+        cache.current.clear()  # Make every file be checked again
+    scan_components(component_map)
+    return set(components.values())
+
+def update_changed_files(changed_files, dependents):
+    """Re-parse the files in `changed_files`, a map from directory to a set
+    of file names, update the direct dependencies of their components and
+    the `dependents` map (see `build_dependents`), and reset the traversal
+    of every component whose levels or cycles might have changed, i.e.,
+    every component that directly or indirectly depends on a changed one.
+    Return the set of such components."""
+    changed = set()
+    for directory, file_names in changed_files.items():
+        directory_indexes.pop(directory, None)  # Test drivers may have changed
+        cache = get_include_cache(directory)
+        for file_name in file_names:
+            cache.current.pop(file_name, None)
+            match = component_file_re.match(file_name)
+            if not match or match[1] not in components:
+                continue
+            component = components[match[1]]
+            if component.directory == directory:
+                changed.add(component)
+
+    for component in sorted(changed, key=lambda c: c.component_name):
+        old_deps = component.dependency_names()
+        component.get_direct_deps()
+        new_deps = component.dependency_names()
+        for dependency_name in old_deps - new_deps:
+            dependents[dependency_name].discard(component)
+        for dependency_name in new_deps - old_deps:
+            dependents.setdefault(dependency_name, set()).add(component)
+        for new_component in scan_components(new_deps - old_deps):
+            for dependency_name in new_component.dependency_names():
+                dependents.setdefault(dependency_name,
+                                      set()).add(new_component)
+
+    affected = set(changed)
+    stack    = list(changed)
+    while stack:
+        component = stack.pop()
+        for dependent in dependents.get(component.component_name, ()):
+            if dependent not in affected:
+                affected.add(dependent)
+                stack.append(dependent)
+
+    for component in affected:
+        component.reset_traversal()
+    return affected
+
+def watch_loop(component_map):
+    """Re-check the components in `component_map` every time one of the
+    files in their packages changes, re-parsing only the changed files and
+    re-leveling only the components that depend on them.  Does not return
+    until interrupted."""
+    directories = sorted(set(package_dirs[component_package(name)]
+                             for name in component_map))
+    try:
+        watcher = inotify_watcher(directories)
+    except OSError:
+        watcher = polling_watcher(directories)
+    dependents = build_dependents()
+    rebuild    = False  # The last update failed; start from scratch
+    print(f"Watching {len(directories)} package directories " +
+          f"using {type(watcher).__name__}...", file=sys.stderr)
+
+    while True:
+        changed_files = watcher.wait()
+        start_time    = time.monotonic()
+        try:
+            if not rebuild:
+                try:
+                    affected = update_changed_files(changed_files,
+                                                    dependents)
+                except OSError as error:
+                    # E.g., a file briefly missing while an editor saves it
+                    # by renaming.  The dependents and traversal state are
+                    # now only partly updated.
+                    print(f"Error: {error}; rebuilding", file=sys.stderr)
+                    rebuild = True
+            if rebuild:
+                affected   = rebuild_graph(component_map)
+                dependents = build_dependents()
+                rebuild    = False
+        except OSError as error:
+            print(f"Error: {error}; rebuilding after the next change",
+                  file=sys.stderr)
+            continue
+        if not affected:
+            continue
+
+        print(time.strftime("=== %H:%M:%S ") +
+              ' '.join(sorted(name for names in changed_files.values()
+                              for name in names
+                              if component_file_re.match(name))) + " ===",
+              file=report_file)
+        report_components(sorted(component.component_name
+                                 for component in affected
+                                 if component.component_name in
+                                 component_map))
+        total_error_count   = 0
+        total_warning_count = 0
+        if repo_dir is not None:
+            total_error_count += report_package_levels()
+        write_outputs(component_map)
+
+        for component_name in component_map:
+            total_error_count   += components[component_name].error_count
+            total_warning_count += components[component_name].warning_count
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        print(f"Total: {total_error_count} errors, " +
+              f"{total_warning_count} warnings " +
+              f"({len(affected)} components re-leveled in " +
+              f"{elapsed_ms:.0f} ms)", file=sys.stderr)
+
+@contextmanager
+def profile_phase(phase):
+    """Accumulate the wall and CPU time spent in the `with` block into
+    `phase_times[phase]`"""
+    start_wall = time.perf_counter()
+    start_cpu  = time.process_time()
+    try:
+        yield
+    finally:
+        times = phase_times.setdefault(phase, [0.0, 0.0])
+        times[0] += time.perf_counter() - start_wall
+        times[1] += time.process_time() - start_cpu
+
+def print_profile(file = sys.stderr):
+    """Print the phase times and counters collected for `--profile`"""
+    print("Profile:", file=file)
+    print(f"    {'Phase':<12} {'Wall (s)':>10} {'CPU (s)':>10}", file=file)
+    for phase, (wall, cpu) in phase_times.items():
+        print(f"    {phase:<12} {wall:>10.3f} {cpu:>10.3f}", file=file)
+    if executor is not None:
+        print("    (CPU time excludes the process pool)", file=file)
+    counters["components visited"] = dfs_counter
+    for counter in ("files stat'ed", "directory scans", "files read",
+                    "objects read", "bytes read", "include matches",
+                    "components visited"):
+        print(f"    {counter + ':':<20} {counters[counter]:>12}", file=file)
+    if slowest_files:
+        print("    Slowest files:", file=file)
+        for seconds, path in sorted(slowest_files, reverse=True):
+            print(f"        {seconds * 1000:9.3f} ms  {path}", file=file)
+
 def usage(error_str = None):
     if error_str is not None:
         print(error_str, file=sys.stderr)
-    print(f"Usage: {progname} [--help] [--verbose] " +
-          "[component|package]...", file=sys.stderr)
+    print(f"Usage: {progname} [--help] [--verbose] [--watch] [--jobs <n>] " +
+          "[--no-cache] [--cache-dir <dir>] [--write-index <file>] " +
+          "[--jsonl <file>] [--preamble] [--bench-scanner] " +
+          "[--profile] [--profile-dump <file>] " +
+          "[--depends <component> <component>] " +
+          "[--dependents <component>] [--dependencies <component>] " +
+          "[--changed <file>]... [--since <revision-range>] " +
+          "[--schedule <file>] [--schedule-format list|make|ninja] " +
+          "[--durations <file>] " +
+          "[component|package]...\n" +
+          f"       {progname} [options] --repo <groups-dir>\n" +
+          f"       {progname} [options] --diff-revisions <old> <new> " +
+          "[--repo <groups-dir> | component|package...]",
+          file=sys.stderr)
+
+def read_mem_file(mem_file_name):
+    """Return the list of names in the specified `.mem` file"""
+    with open(mem_file_name, 'r') as mem_file:
+        return parse_mem_file(mem_file.read())
+
+def parse_mem_file(mem_file_content):
+    """Return the list of names in the specified `.mem` file content"""
+    mem_file_content = \
+        re.sub("#.*$", "", mem_file_content, flags=re.MULTILINE)
+    return re.findall(r"(\w+)", mem_file_content)
+
+def discover_repo(root):
+    """Find every package under the `groups` directory `root` (or under
+    `root/groups`), recording its directory and group, and return the paths
+    of all of their components"""
+    if os.path.isdir(os.path.join(root, "groups")):
+        root = os.path.join(root, "groups")
+    ret = []
+    mem_file_glob = os.path.join(root, "*", "*", "package", "*.mem")
+    for mem_file_name in sorted(glob(mem_file_glob)):
+        package_path = os.path.dirname(os.path.dirname(mem_file_name))
+        package      = os.path.basename(package_path)
+        package_dirs[package]   = package_path
+        package_groups[package] = \
+            os.path.basename(os.path.dirname(package_path))
+        for component_name in read_mem_file(mem_file_name):
+            component_packages[component_name] = package
+            ret.append(os.path.join(package_path, component_name))
+    return ret
+
+def make_component_map(paths):
+    """Return a map from component name to path for the specified component
+    `paths`, recording the package directory of each outside `--repo`
+    mode"""
+    component_map = dict()
+    for name in paths:
+        if name == "": continue
+        component_path = cpp03_re.sub("", suffix_re.sub("", name))
+        component_name = os.path.basename(component_path)
+        component_map[component_name] = component_path
+        if repo_dir is None:
+            package_dirs[component_package(component_name)] = \
+                os.path.dirname(component_path)
+    return component_map
 
 def process_args(argv):
     global progname
     global verbose
+    global use_cache
+    global cache_dir
+    global jobs
+    global repo_dir
+    global watch
+    global index_file
+    global preamble_only
+    global bench_scanner
+    global profiling
+    global profile_file
+    global jsonl_file
+    global report_file
+    global changed_files
+    global git_range
+    global schedule_file
+    global schedule_format
+    global durations
+    global revisions
 
     progname = os.path.basename(argv[0])
     cpt_args = []
-    for arg in argv[1:]:
+    args     = iter(argv[1:])
+    for arg in args:
         if arg == "--help":
             usage()
             return None
         elif arg == "--verbose":
             verbose = True
             continue
+        elif arg == "--jobs" or arg == "-j":
+            jobs = next(args, "")
+            if not jobs.isdigit():
+                usage("--jobs requires a numeric argument")
+                return None
+            jobs = int(jobs)
+            continue
+        elif arg == "--watch":
+            watch = True
+            continue
+        elif arg == "--preamble":
+            preamble_only = True
+            continue
+        elif arg == "--bench-scanner":
+            bench_scanner = True
+            continue
+        elif arg == "--profile":
+            profiling = True
+            continue
+        elif arg == "--profile-dump":
+            profile_file = next(args, None)
+            if profile_file is None:
+                usage("Missing argument for --profile-dump")
+                return None
+            continue
+        elif arg == "--write-index":
+            index_file = next(args, None)
+            if index_file is None:
+                usage("Missing argument for --write-index")
+                return None
+            continue
+        elif arg == "--jsonl":
+            jsonl_file = next(args, None)
+            if jsonl_file is None:
+                usage("Missing argument for --jsonl")
+                return None
+            continue
+        elif arg in ("--depends", "--dependents", "--dependencies"):
+            names = [next(args, None) for i in
+                     range(2 if arg == "--depends" else 1)]
+            if None in names:
+                usage(f"Missing argument for {arg}")
+                return None
+            queries.append((arg[2:], *names))
+            continue
+        elif arg == "--changed":
+            file_name = next(args, None)
+            if file_name is None:
+                usage("Missing argument for --changed")
+                return None
+            if changed_files is None:
+                changed_files = []
+            if file_name == '-':
+                changed_files.extend(line.strip() for line in sys.stdin
+                                     if line.strip())
+            else:
+                changed_files.append(file_name)
+            continue
+        elif arg == "--since":
+            git_range = next(args, None)
+            if git_range is None:
+                usage("Missing argument for --since")
+                return None
+            if changed_files is None:
+                changed_files = []
+            continue
+        elif arg == "--schedule":
+            schedule_file = next(args, None)
+            if schedule_file is None:
+                usage("Missing argument for --schedule")
+                return None
+            continue
+        elif arg == "--schedule-format":
+            schedule_format = next(args, None)
+            if schedule_format not in ("list", "make", "ninja"):
+                usage("--schedule-format must be list, make or ninja")
+                return None
+            continue
+        elif arg == "--durations":
+            file_name = next(args, None)
+            if file_name is None:
+                usage("Missing argument for --durations")
+                return None
+            try:
+                durations = read_durations(file_name)
+            except (OSError, ValueError) as error:
+                usage(f"Invalid --durations file: {error}")
+                return None
+            continue
+        elif arg == "--diff-revisions":
+            revisions = (next(args, None), next(args, None))
+            if None in revisions:
+                usage("--diff-revisions requires two revision arguments")
+                return None
+            continue
+        elif arg == "--no-cache":
+            use_cache = False
+            continue
+        elif arg == "--repo":
+            repo_dir = next(args, None)
+            if repo_dir is None or not os.path.isdir(repo_dir):
+                usage("--repo requires a directory argument")
+                return None
+            continue
+        elif arg == "--cache-dir":
+            cache_dir = next(args, None)
+            if cache_dir is None:
+                usage("Missing argument for --cache-dir")
+                return None
+            continue
         elif arg.startswith("-"):
             usage(f"Invalid option: {arg}")
             return None
         else:
             cpt_args.append(arg)
 
+    if '-' in (jsonl_file, schedule_file):
+        # Keep the report out of the output
+        report_file = sys.stderr
+
+    if repo_dir is not None:
+        if cpt_args:
+            usage("Component or package arguments not allowed with --repo")
+            return None
+        if revisions is not None:
+            return []  # Discovered in each revision
+        return discover_repo(repo_dir)
+
     if not cpt_args:
         usage()
         return None
+    if revisions is not None:
+        return cpt_args  # Expanded in each revision
 
     # TBD: Error handling for missing directories or components belongs below
     ret = []
@@ -276,52 +2438,107 @@ def process_args(argv):
             mem_file_glob = os.path.join(package_path, "package", "*.mem")
             mem_file_list = glob(mem_file_glob)
             assert(1 == len(mem_file_list))
-            with open(mem_file_list[0], 'r') as mem_file:
-                mem_file_content = mem_file.read()
-                mem_file_content = \
-                    re.sub("#.*$", "", mem_file_content, re.MULTILINE)
-                ret += map(lambda x: os.path.join(package_path, x),
-                           re.findall(r"(\w+)", mem_file_content))
+            ret += map(lambda x: os.path.join(package_path, x),
+                       read_mem_file(mem_file_list[0]))
         else:
             ret.append(arg)
 
     return ret
 
-if __name__ == "__main__":
-    args = process_args(sys.argv)
-    if args is None:
-        exit(1)
+def run(args):
+    """Run the mode selected by the options on the components named by
+    `args`, and return the exit status.  Saving the caches, shutting down
+    the process pool and writing the profile are left to the caller, so
+    that they happen whichever mode runs."""
+    if revisions is not None:
+        return diff_revisions(args)
 
-    component_map = dict()
-    for name in args:
-        if name == "": continue
-        component_path = cpp03_re.sub("", suffix_re.sub("", name))
-        component_name = os.path.basename(component_path)
-        component_map[component_name] = component_path
+    component_map = make_component_map(args)
 
-    total_error_count   = 0
-    total_warning_count = 0
-    original_dir = os.getcwd()
-    for component_name, component_path in sorted(component_map.items()):
-
-        if package != component_name.split('_')[0]:
-            package_path = os.path.dirname(component_path)
-            package      = component_name.split('_')[0]
-            os.chdir(original_dir)
-            if package_path:
-                os.chdir(package_path)
-            include_re = re.compile(include_pattern.replace("PKG", package),
-                                    re.MULTILINE)
+    if queries:
+        return answer_queries(get_reachability_index(component_map))
 
-        component = visit_by_name(component_name)
-        total_error_count   += component.error_count
-        total_warning_count += component.warning_count
-        if verbose or component.error_count > 0 or component.warning_count > 0:
-            print(component)
+    if git_range is not None:
+        paths = git_changed_files(git_range)
+        if paths is None:
+            return 2
+        changed_files.extend(paths)
+
+    with profile_phase("scan"):
+        scan_components(component_map)
+
+    if changed_files is not None:
+        with profile_phase("impact"):
+            report_impact(changed_files)
+        return 0
+
+    if bench_scanner:
+        return benchmark_scanners([os.path.join(component.directory,
+                                                file_name)
+                                   for name, component in
+                                   sorted(components.items())
+                                   for file_name in component.files()])
+
+    with profile_phase("traverse"):
+        for component_name in sorted(component_map):
+            visit_by_name(component_name)
+
+    with profile_phase("report"):
+        total_error_count, total_warning_count = \
+            report_components(sorted(component_map))
+
+        if repo_dir is not None:
+            total_error_count += report_package_levels()
+
+    with profile_phase("write"):
+        write_outputs(component_map)
 
     if total_error_count or total_warning_count:
         print(f"Total: {total_error_count} errors, " +
               f"{total_warning_count} warnings", file=sys.stderr)
 
-    if total_error_count:
-        exit(total_error_count)
+    try:
+        if watch:
+            watch_loop(component_map)
+    except KeyboardInterrupt:
+        pass
+    return total_error_count
+
+if __name__ == "__main__":
+    start_wall = time.perf_counter()
+    start_cpu  = time.process_time()
+    args = process_args(sys.argv)
+    if args is None:
+        exit(1)
+    phase_times["discover"] = [time.perf_counter() - start_wall,
+                               time.process_time() - start_cpu]
+
+    profiler = None
+    if profile_file is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    status = 1
+    try:
+        status = run(args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader of the output (e.g., `head`) has exited; stop quietly
+        # with the status of a process killed by `SIGPIPE`.  Pointing `stdout`
+        # at /dev/null stops the flush at exit failing.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        status = 128 + signal.SIGPIPE
+    finally:
+        with profile_phase("save"):
+            for cache in include_caches.values():
+                cache.save()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if profiling:
+            print_profile()
+        if executor is not None:
+            executor.shutdown()
+
+    if status:
+        exit(status)
@@ -0,0 +1,320 @@
+#! /usr/bin/python3
+
+"""Benchmark `dependency-check.py` and `component_cycles.py` on synthetic
+BDE-style packages.
+
+For each requested size, a package is generated in a temporary directory
+with the specified number of components, each depending on `--fanout`
+randomly-chosen lower-numbered components, plus a dependency chain `--depth`
+components long and `--cycles` dependency cycles.  Test drivers are a mix of
+`.t.cpp`, `.xt.cpp` and numbered `.N.t.cpp` files, and the package has a
+`.mem` file.  The scan, traversal and report phases of each tool are then
+timed (wall and CPU time) and, in a second pass, the peak Python memory
+allocated during each phase is measured with `tracemalloc`.  Each pass runs
+in a child process, which is killed if it takes longer than `--timeout`
+seconds, and the peak resident set size of that process is also reported.
+
+Usage: dependency_bench.py [--sizes <n>,...] [--fanout <n>] [--depth <n>]
+                           [--cycles <n>] [--jobs <n>] [--tools <tool>,...]
+                           [--timeout <seconds>] [--no-memory] [--keep]
+                           [--seed <n>]"""
+
+import sys
+import os
+import io
+import time
+import random
+import shutil
+import resource
+import tempfile
+import tracemalloc
+import importlib.util
+import multiprocessing
+
+progname = "PROGRAM"
+tools    = ("dependency-check", "component_cycles")
+
+def usage(error_str = None):
+    if error_str is not None:
+        print(error_str, file=sys.stderr)
+    print(__doc__[__doc__.index("Usage:"):], file=sys.stderr)
+
+def generate_package(root, num_components, fanout, depth, num_cycles, seed):
+    """Generate a synthetic package with `num_components` components under
+    `root` and return the tuple `(package_path, component_names)`"""
+    rand         = random.Random(seed)
+    package      = "zzzb"
+    package_path = os.path.join(root, "groups", "zzz", package)
+    os.makedirs(os.path.join(package_path, "package"))
+    names = [f"{package}_cmp{i:06d}" for i in range(num_components)]
+
+    deps     = [set() for name in names]
+    testdeps = [set() for name in names]
+    for i in range(1, num_components):
+        if i < depth:
+            deps[i].add(i - 1)
+        for j in range(min(fanout, i)):
+            deps[i].add(rand.randrange(i))
+        if rand.random() < 0.25:
+            testdeps[i].add(rand.randrange(i))
+    for i in range(min(num_cycles, num_components // 2)):
+        # Make two components depend on each other
+        high = rand.randrange(1, num_components)
+        low  = rand.randrange(high)
+        deps[high].add(low)
+        deps[low].add(high)
+
+    for i, name in enumerate(names):
+        with open(os.path.join(package_path, name + ".h"), 'w') as file:
+            file.write(f"// {name}.h\n#ifndef INCLUDED_{name.upper()}\n" +
+                       f"#define INCLUDED_{name.upper()}\n\n" +
+                       "".join(f"#include <{names[dep]}.h>\n"
+                               for dep in sorted(deps[i])) +
+                       "\nnamespace BloombergLP {\n}\n#endif\n")
+        with open(os.path.join(package_path, name + ".cpp"), 'w') as file:
+            file.write(f"// {name}.cpp\n#include <{name}.h>\n\n" +
+                       "".join(f"#include <{names[dep]}.h>  // for testing "
+                               "only\n" for dep in sorted(testdeps[i])))
+        driver = (f"// test driver\n#include <{name}.h>\n" +
+                  "".join(f"#include <{names[dep]}.h>\n"
+                          for dep in sorted(testdeps[i])) +
+                  "\nint main(int argc, char *argv[])\n{\n" +
+                  "    int test = argc > 1 ? atoi(argv[1]) : 0;\n}\n")
+        style = i % 4
+        if style == 1:
+            test_files = [name + ".xt.cpp"]
+        elif style == 2:
+            test_files = [f"{name}.{n}.t.cpp" for n in range(3)]
+        else:
+            test_files = [name + ".t.cpp"]
+        for test_file in test_files:
+            with open(os.path.join(package_path, test_file), 'w') as file:
+                file.write(driver)
+
+    with open(os.path.join(package_path, "package", package + ".mem"),
+              'w') as file:
+        file.write("# Synthetic package\n" + "\n".join(names) + "\n")
+
+    return package_path, names
+
+def load_tool(tool):
+    """Load a fresh copy of the specified tool script as a module"""
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        tool + ".py")
+    spec   = importlib.util.spec_from_file_location(tool.replace('-', '_'),
+                                                    path)
+    module = importlib.util.module_from_spec(spec)
+    # Register the module so that a process pool can pickle its functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def dependency_check_phases(package_path, names, jobs, cache_dir):
+    """Return a list of `(phase, function)` pairs running
+    `dependency-check.py` on the package at `package_path`"""
+    dc = load_tool("dependency-check")
+    dc.jobs      = jobs
+    dc.use_cache = cache_dir is not None
+    if cache_dir is not None:
+        dc.cache_dir = cache_dir
+    dc.package_dirs[os.path.basename(package_path)] = package_path
+
+    def report():
+        out = io.StringIO()
+        for name in names:
+            print(dc.components[name], file=out)
+        return out
+
+    def cleanup():
+        for cache in dc.include_caches.values():
+            cache.save()
+        if dc.executor is not None:
+            dc.executor.shutdown()
+
+    return [("scan",     lambda: dc.scan_components(names)),
+            ("traverse", lambda: [dc.visit_by_name(name) for name in names]),
+            ("report",   report),
+            (None,       cleanup)]
+
+def component_cycles_phases(package_path, names, jobs, cache_dir):
+    """Return a list of `(phase, function)` pairs running
+    `component_cycles.py` on the package at `package_path`"""
+    cc     = load_tool("component_cycles")
+    files  = [os.path.join(package_path, name + suffix)
+              for name in names for suffix in (".h", ".cpp")]
+    result = { }
+
+    def scan():
+        # `component_cycles.py` expects to be run in the package directory
+        original_dir = os.getcwd()
+        os.chdir(package_path)
+        try:
+            result["graph"] = cc.build_dependency_graph(
+                [os.path.basename(file_name) for file_name in files])
+        finally:
+            os.chdir(original_dir)
+
+    def traverse():
+        result["clusters"] = cc.strongly_connected(result["graph"])
+        result["cycles"]   = cc.find_cycles(result["graph"],
+                                            cc.default_max_cycles)[0]
+
+    def report():
+        return ("\n".join(" ".join(cluster)
+                          for cluster in result["clusters"]) +
+                "\n".join(" -> ".join(cycle)
+                          for cycle in sorted(result["cycles"])))
+
+    return [("scan", scan), ("traverse", traverse), ("report", report)]
+
+phase_factories = {
+    "dependency-check" : dependency_check_phases,
+    "component_cycles" : component_cycles_phases,
+}
+
+def run_phases(phases, measure_memory):
+    """Run `phases` in order and return a map from phase name to
+    `(wall-time, cpu-time, peak-bytes)`, where `peak-bytes` is `None` unless
+    `measure_memory` is true"""
+    ret = { }
+    for phase, function in phases:
+        if measure_memory:
+            tracemalloc.start()
+        start_wall = time.perf_counter()
+        start_cpu  = time.process_time()
+        function()
+        wall = time.perf_counter() - start_wall
+        cpu  = time.process_time() - start_cpu
+        peak = None
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if phase is not None:
+            ret[phase] = (wall, cpu, peak)
+    return ret
+
+def run_case(tool, package_path, names, jobs, measure_memory, connection):
+    """Run the phases of `tool` and send the results of `run_phases`, along
+    with the peak resident set size in bytes, through `connection`.  Runs
+    in a child process."""
+    phases  = phase_factories[tool](package_path, names, jobs, None)
+    results = run_phases(phases, measure_memory)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024  # Linux reports kilobytes
+    connection.send((results, max_rss))
+
+def measure(tool, package_path, names, jobs, measure_memory, timeout):
+    """Run `run_case` in a child process and return its results, or `None`
+    if it does not finish within `timeout` seconds.  Raise `RuntimeError` if
+    the child fails."""
+    context          = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case,
+                              args=(tool, package_path, names, jobs,
+                                    measure_memory, sender))
+    process.start()
+    sender.close()  # So that `receiver` sees EOF if the child dies
+    if not receiver.poll(timeout):
+        process.kill()
+        process.join()
+        return None
+    try:
+        ret = receiver.recv()
+    except EOFError:
+        ret = None
+    process.join()
+    if ret is None or process.exitcode != 0:
+        raise RuntimeError(f"exited with status {process.exitcode}")
+    return ret
+
+def process_args(argv):
+    global progname
+    progname = os.path.basename(argv[0])
+    options  = { "sizes" : [100, 1000, 10000, 100000], "fanout" : 3,
+                 "depth" : 50, "cycles" : 5, "jobs" : 1, "timeout" : 300,
+                 "tools" : list(tools), "memory" : True, "keep" : False,
+                 "seed" : 1 }
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--help":
+            usage()
+            return None
+        elif arg == "--no-memory":
+            options["memory"] = False
+        elif arg == "--keep":
+            options["keep"] = True
+        elif arg in ("--sizes", "--tools"):
+            value = next(args, None)
+            if value is None:
+                usage(f"Missing argument for {arg}")
+                return None
+            values = value.split(',')
+            if arg == "--tools":
+                if not set(values) <= set(tools):
+                    usage(f"Unknown tool in {value}")
+                    return None
+                options["tools"] = values
+            elif all(size.isdigit() for size in values):
+                options["sizes"] = [int(size) for size in values]
+            else:
+                usage(f"Invalid sizes: {value}")
+                return None
+        elif arg in ("--fanout", "--depth", "--cycles", "--jobs", "--seed",
+                     "--timeout"):
+            value = next(args, "")
+            if not value.isdigit():
+                usage(f"{arg} requires a numeric argument")
+                return None
+            options[arg[2:]] = int(value)
+        else:
+            usage(f"Invalid argument: {arg}")
+            return None
+    return options
+
+if __name__ == "__main__":
+    options = process_args(sys.argv)
+    if options is None:
+        exit(1)
+
+    print(f"{'tool':<17} {'components':>10} {'phase':<9} {'wall (s)':>9} " +
+          f"{'cpu (s)':>9} {'peak (MB)':>10} {'rss (MB)':>9}")
+    for size in options["sizes"]:
+        root = tempfile.mkdtemp(prefix="dependency_bench.")
+        try:
+            start_time = time.perf_counter()
+            package_path, names = generate_package(
+                root, size, options["fanout"], options["depth"],
+                options["cycles"], options["seed"])
+            print(f"# Generated {size} components in " +
+                  f"{time.perf_counter() - start_time:.2f} s under {root}",
+                  file=sys.stderr)
+
+            for tool in options["tools"]:
+                try:
+                    timings = measure(tool, package_path, names,
+                                      options["jobs"], False,
+                                      options["timeout"])
+                    if timings is None:
+                        print(f"{tool:<17} {size:>10} timed out after " +
+                              f"{options['timeout']} s", flush=True)
+                        continue
+                    peaks = None
+                    if options["memory"]:
+                        peaks = measure(tool, package_path, names,
+                                        options["jobs"], True,
+                                        options["timeout"])
+                except RuntimeError as error:
+                    print(f"{tool:<17} {size:>10} failed: {error}",
+                          flush=True)
+                    continue
+                timings, max_rss = timings
+                for phase, (wall, cpu, peak) in timings.items():
+                    peak = "-" if peaks is None else \
+                        f"{peaks[0][phase][2] / 2**20:.1f}"
+                    print(f"{tool:<17} {size:>10} {phase:<9} {wall:>9.3f} " +
+                          f"{cpu:>9.3f} {peak:>10} {max_rss / 2**20:>9.1f}",
+                          flush=True)
+        finally:
+            if not options["keep"]:
+                shutil.rmtree(root)
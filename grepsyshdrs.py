@@ -1,53 +1,872 @@
 #! /usr/bin/python3
 
-"""Find the standard headers with the specified file names.  This first version
-uses gcc-11 in C++20 mode.  Future versions might allow versioning.
+r"""Find the standard headers with the specified file names.  This first version
+uses gcc-11 in C++20 mode by default; `--cxx=<compiler>` and `--std=<std>`
+select a different compiler or standard.
 
-Usage: findstdhdr.py <header-name>..."""
+Both options may be repeated or given comma-separated lists, in which case
+every combination of compiler and standard is searched (matrix mode).  The
+closures of the configurations are computed concurrently, files shared by
+several configurations (the same inode, or the same contents) are searched
+only once, and each line of output is tagged with the configurations, as
+`[<compiler>/<std>,...]`, whose closures include the file.
+
+The set of headers transitively included by the specified headers is cached
+under `$XDG_CACHE_HOME/grepsyshdrs` (default `~/.cache/grepsyshdrs`), keyed by
+the compiler, standard and headers, and is recomputed only if the compiler
+binary changes, so repeated searches do not run the compiler at all.
+
+The headers are searched in parallel by a built-in engine that understands the
+common `egrep` options `-i`, `-w`, `-l`, `-n`, `-h`, `-H`, `-A`, `-B`, `-C`
+and `-e` and prints its results in the same format and file order as `egrep`.
+For any other option, or with `--egrep`, `egrep` itself is run instead (on as
+many batches of files as are needed to stay within the argument size limit).
+`--jobs=<n>` sets the number of search processes (default: one per CPU).
+
+With `--index`, the built-in engine first narrows the files to search using a
+trigram index of the headers, which is saved next to the cached closure and
+rebuilt whenever the closure or any of its files changes.
+
+The pattern is a POSIX extended regular expression, as for `egrep`.  The
+built-in engine translates the syntax Python lacks (bracket classes such as
+`[[:space:]]`, and `\<` and `\>`), and leaves any pattern it cannot translate
+to `egrep`.  `--check-egrep` runs both `egrep` and the built-in engine (with
+the index, if `--index` is given), prints the `egrep` output and reports any
+difference between the two, with exit status 3.
+
+Usage: findstdhdr.py [--cxx=<compiler>,...]... [--std=<std>,...]...
+                     [--jobs=<n>] [--egrep] [--index] [--check-egrep]
+                     <regex> <header>..."""
 
 import sys
 import subprocess as sp
 import re
 import os
+import json
+import shutil
+import hashlib
+import mmap
+import pickle
+import bisect
+import signal
+import io
+import difflib
+import warnings
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+compilers = []      # `--cxx` values (default: `g++-11`)
+stds      = []      # `--std` values (default: `c++20`)
+jobs      = os.cpu_count() or 1
+use_egrep = False
+use_index = False
+check_egrep = False  # Compare the built-in engine with `egrep`
+cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                        os.path.expanduser("~/.cache")),
+                         "grepsyshdrs")
+
+# Files at least this large are memory-mapped rather than read
+mmap_threshold = 256 * 1024
+
+# Bump this number whenever the format of the saved `trigram_index` changes
+index_version = 1
+
+# Parsed regular-expression operators that repeat a subpattern
+repeat_ops = tuple(getattr(sre_constants, op)
+                   for op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+                   if hasattr(sre_constants, op))
+
+# The POSIX character classes, in the C locale, as Python character-set items
+posix_classes = { "alpha"  : "a-zA-Z",     "digit" : "0-9",
+                  "alnum"  : "0-9a-zA-Z",  "upper" : "A-Z",
+                  "lower"  : "a-z",        "space" : r" \t\n\r\f\v",
+                  "blank"  : r" \t",        "punct" : r"!-/:-@\[-`{-~",
+                  "print"  : r"\x20-\x7e", "graph" : r"\x21-\x7e",
+                  "cntrl"  : r"\x00-\x1f\x7f", "xdigit" : "0-9A-Fa-f" }
+
+interval_re = re.compile(r"\{[0-9]*(,[0-9]*)?\}")
+
+# Options for the built-in search engine, set in each worker process by
+# `init_search`
+search_options = None
 
 def usage(msg = None):
     if msg is not None:
-        sys.stderr.write(msg)
-    sys.stderr.write(f"Usage: {sys.argv[0]} <regex> <header>...")
-
-if len(sys.argv) < 3:
-    usage("Not enough command-line arguments")
-
-# The header file name is the last command-line argument unless there is a "--"
-# in the command line, in which case the header file is all of the arguments
-# following the "--".  The grep arguments are all of the arguments up to the
-# first header argument (excluding any "--").
-if "--" in sys.argv:
-    dd_index = sys.argv.index("--")
-    grepargs = sys.argv[1:dd_index]
-    headers  = sys.argv[dd_index+1:]
-else:
-    grepargs = sys.argv[1:-1]
-    headers  = sys.argv[-1:]
-
-tmpfilename = "/tmp/findstdhdr_dummy.cpp"
-
-# Generate a temporary .cpp file having one '#include' line for each header
-with open(tmpfilename, "w+") as cfile:
-    for header in headers:
-        cfile.write(f"#include <{header}>\n")
-
-# Collect the full path names of the headers plus any headers they include,
-# transitively.
-cmpresult = sp.run(["g++-11", "-M", "-std=c++20", tmpfilename],
-                   stdout=sp.PIPE).stdout.decode("ascii")
-
-os.remove(tmpfilename)
-
-# Split the output into separate header-file names to grep.  The first two
-# words of output are an intro phrase and the name of the temporary file, so we
-# discard those.
-grepfiles = re.split(r'\s*\\?\s+', cmpresult)[2:]
-if not grepfiles[-1]: grepfiles = grepfiles[:-1]
-
-sp.run(["egrep"] + grepargs + grepfiles)
+        sys.stderr.write(msg + "\n")
+    sys.stderr.write(f"Usage: {sys.argv[0]} [--cxx=<compiler>,...]... "
+                     "[--std=<std>,...]... [--jobs=<n>] [--egrep] [--index] "
+                     "[--check-egrep] <regex> <header>...\n")
+
+class closure_error(Exception):
+    """Raised when the header closure of a configuration cannot be found.
+    `status` is the exit status to report."""
+
+    def __init__(self, message, status = 1):
+        super().__init__(message)
+        self.status = status
+
+def compiler_closure(compiler_path, std, headers):
+    """Run `compiler_path` and return the full path names of the `headers`
+    plus any headers they include, transitively"""
+    # Feed the `#include` lines through stdin rather than a temporary file so
+    # that concurrent runs cannot interfere with each other.
+    source    = "".join(f"#include <{header}>\n" for header in headers)
+    cmpresult = sp.run([compiler_path, "-M", f"-std={std}", "-x", "c++", "-"],
+                       input=source.encode("ascii"), stdout=sp.PIPE)
+    if cmpresult.returncode != 0:
+        # The compiler has already explained why
+        raise closure_error(None, cmpresult.returncode)
+
+    # Split the output into separate header-file names.  The first word of
+    # output is the target name (`-:`), which we discard.
+    return [name for name in
+            re.split(r'\s*\\?\s+', cmpresult.stdout.decode("ascii"))[1:]
+            if name and name != '-']
+
+def header_closure(compiler, std, headers):
+    """Return the tuple `(files, closure_id)`, where `files` is the full path
+    names of the `headers` plus any headers they include, transitively, as
+    found by `compiler` in `-std=<std>` mode, from the cache if the compiler
+    binary has not changed since it was cached, and `closure_id` is a string
+    identifying the compiler, standard and headers"""
+    compiler_path = shutil.which(compiler)
+    if compiler_path is None:
+        raise closure_error(f"{compiler}: compiler not found")
+    compiler_path = os.path.realpath(compiler_path)
+    stat          = os.stat(compiler_path)
+    key           = [compiler_path, std, headers]
+    closure_id    = \
+        hashlib.blake2b(json.dumps(key).encode(), digest_size=8).hexdigest()
+    cache_file    = os.path.join(cache_dir, f"closure-{closure_id}.json")
+
+    try:
+        with open(cache_file) as file:
+            cached = json.load(file)
+        if (cached["key"] == key and
+            cached["compiler_mtime_ns"] == stat.st_mtime_ns and
+            cached["compiler_size"] == stat.st_size and
+            all(os.path.exists(name) for name in cached["files"])):
+            return cached["files"], closure_id
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # Missing, corrupt or stale cache; run the compiler
+
+    files = compiler_closure(compiler_path, std, headers)
+
+    # Write to a temporary file and rename so that a concurrent run never
+    # sees a partially-written cache.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump({ "key"               : key,
+                    "compiler_mtime_ns" : stat.st_mtime_ns,
+                    "compiler_size"     : stat.st_size,
+                    "files"             : files }, file)
+    os.replace(tmp_file, cache_file)
+    return files, closure_id
+
+def file_trigrams(file_name):
+    """Return the set of (lowercased) trigrams in `file_name`, each as an
+    `int`"""
+    with open(file_name, "rb") as file:
+        content = file.read().lower()
+    return set((a << 16) | (b << 8) | c
+               for a, b, c in set(zip(content, content[1:], content[2:])))
+
+class trigram_index:
+    """Persistent inverted index from each trigram (lowercased, so that it
+    also serves case-insensitive searches) to the numbers of the files in a
+    header closure that contain it.  A search uses the literal strings that
+    any match of the regular expression must contain to narrow the files to
+    search."""
+
+    def __init__(self, closure_id, files):
+        self.index_file = os.path.join(cache_dir,
+                                       f"trigrams-{closure_id}.pickle")
+        self.files      = files
+        self.signatures = []   # `(size, mtime_ns)` of each file
+
+        # The numbers of the files containing trigram `trigrams[i]` are
+        # `postings[offsets[i]:offsets[i + 1]]`.  Flat arrays, rather than
+        # a `dict`, make loading the index nearly free.
+        self.trigrams   = array('I')
+        self.offsets    = array('I', [0])
+        self.postings   = array('I')
+
+    def file_signatures(self):
+        ret = []
+        for file_name in self.files:
+            stat = os.stat(file_name)
+            ret.append((stat.st_size, stat.st_mtime_ns))
+        return ret
+
+    def load(self):
+        """Load the saved index and return true if it is up to date, or
+        return false otherwise"""
+        try:
+            with open(self.index_file, "rb") as file:
+                version, files, state = pickle.load(file)
+            if (version != index_version or files != self.files or
+                state["signatures"] != self.file_signatures()):
+                return False
+        except (OSError, EOFError, ValueError, KeyError,
+                pickle.UnpicklingError):
+            return False  # Missing or corrupt index
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+        return True
+
+    def build(self):
+        self.signatures = self.file_signatures()
+        postings        = { }
+        if jobs > 1 and len(self.files) >= 4 * jobs:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(
+                    file_trigrams, self.files,
+                    chunksize=max(1, len(self.files) // (jobs * 8))))
+        else:
+            results = map(file_trigrams, self.files)
+        for file_number, trigrams in enumerate(results):
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(file_number)
+        self.trigrams = array('I', sorted(postings))
+        self.offsets  = array('I', [0])
+        self.postings = array('I')
+        for trigram in self.trigrams:
+            self.postings.extend(postings[trigram])
+            self.offsets.append(len(self.postings))
+
+    def save(self):
+        # Write to a temporary file and rename so that a concurrent run never
+        # sees a partially-written index.
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as file:
+            state = { attribute: getattr(self, attribute) for attribute in
+                      ("signatures", "trigrams", "offsets", "postings") }
+            pickle.dump((index_version, self.files, state), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+
+    def posting(self, trigram):
+        """Return the numbers of the files containing `trigram`"""
+        i = bisect.bisect_left(self.trigrams, trigram)
+        if i == len(self.trigrams) or self.trigrams[i] != trigram:
+            return ()
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def literal_candidates(self, literal):
+        """Return the set of numbers of the files containing every trigram
+        of the lowercased `literal`, or `None` (meaning every file) if it is
+        too short to have any"""
+        if len(literal) < 3:
+            return None
+        postings = sorted((self.posting(
+            (literal[i] << 16) | (literal[i + 1] << 8) | literal[i + 2])
+                           for i in range(len(literal) - 2)), key=len)
+        ret = set(postings[0])
+        for posting in postings[1:]:
+            if not ret:
+                break
+            ret.intersection_update(posting)
+        return ret
+
+    def pattern_candidates(self, tokens):
+        """Return the set of numbers of the files that might contain a
+        match of the parsed regular expression `tokens`, or `None` if any
+        file might"""
+        ret     = None
+        literal = bytearray()
+
+        def restrict(candidates):
+            nonlocal ret
+            if candidates is not None:
+                ret = candidates if ret is None else ret & candidates
+
+        for op, av in list(tokens) + [(None, None)]:
+            if op is sre_constants.LITERAL:
+                literal.append(av)
+                continue
+            restrict(self.literal_candidates(bytes(literal).lower()))
+            literal.clear()
+            if op is sre_constants.SUBPATTERN:
+                restrict(self.pattern_candidates(av[-1]))
+            elif op in repeat_ops:
+                if av[0] >= 1:
+                    restrict(self.pattern_candidates(av[2]))
+            elif op is sre_constants.BRANCH:
+                alternatives = [self.pattern_candidates(alternative)
+                                for alternative in av[1]]
+                if None not in alternatives:
+                    restrict(set().union(*alternatives))
+        return ret
+
+    def candidates(self, pattern):
+        """Return the files, in closure order, that might contain a match of
+        the regular expression `pattern`"""
+        try:
+            tokens = sre_parse.parse(
+                pattern.encode("utf-8", "surrogateescape"))
+        except re.error:
+            return self.files  # Let the search report the error
+        file_numbers = self.pattern_candidates(tokens)
+        if file_numbers is None:
+            return self.files
+        return [self.files[file_number]
+                for file_number in sorted(file_numbers)]
+
+def translate_bracket(pattern, start):
+    """Return the tuple `(translation, end)` for the bracket expression
+    starting at `pattern[start]`, where `translation` is the equivalent
+    Python character set, or `None` if it cannot be translated, and `end` is
+    the offset just past the bracket expression"""
+    escape = lambda c: "\\" + c if c in "\\]^-[&~|" else c
+    pos    = start + 1
+    negate = pattern.startswith("^", pos)
+    if negate:
+        pos += 1
+    items = []
+    first = True
+    while True:
+        if pos >= len(pattern):
+            return None, pos  # Unmatched `[`
+        c = pattern[pos]
+        if c == "]" and not first:
+            break
+        first = False
+        if c == "[" and pattern[pos + 1:pos + 2] in (":", "=", "."):
+            kind = pattern[pos + 1]
+            end  = pattern.find(kind + "]", pos + 2)
+            if end < 0:
+                return None, pos
+            name = pattern[pos + 2:end]
+            pos  = end + 2
+            if kind == ":":
+                if name not in posix_classes:
+                    return None, pos
+                items.append(posix_classes[name])
+                continue
+            if len(name) != 1:
+                return None, pos  # Multi-character collating element
+            c = name
+        else:
+            pos += 1
+        if not c.isascii():
+            return None, pos  # A byte-oriented set would differ
+        if (pattern[pos:pos + 1] == "-" and
+            pattern[pos + 1:pos + 2] not in ("", "]")):
+            high = pattern[pos + 1]
+            if high == "[" or not high.isascii():
+                return None, pos
+            items.append(escape(c) + "-" + escape(high))
+            pos += 2
+        else:
+            items.append(escape(c))
+    # As in `egrep`, a negated set never matches the end of a line
+    return "[" + ("^\\n" if negate else "") + "".join(items) + "]", pos + 1
+
+def translate_ere(pattern):
+    """Return the POSIX extended regular expression `pattern`, as
+    understood by GNU `egrep`, translated to a Python regular expression
+    that matches the same lines, or `None` if it uses syntax that is not
+    translated (which is then left to `egrep`)"""
+    ret        = []
+    pos        = 0
+    quantified = False  # The last item was a quantifier
+    while pos < len(pattern):
+        c = pattern[pos]
+        if c in "*+?{":
+            if c == "{":
+                match = interval_re.match(pattern, pos)
+                if match is None:
+                    return None  # A literal `{` in `egrep`
+                c = match[0]
+            if quantified:
+                return None  # Repeated quantifiers mean something else
+            ret.append(c)
+            pos       += len(c)
+            quantified = True
+            continue
+        quantified = False
+        if c == "\\":
+            c    = pattern[pos + 1:pos + 2]
+            pos += 2
+            if c == "<":
+                ret.append(r"\b(?=\w)")
+            elif c == ">":
+                ret.append(r"\b(?<=\w)")
+            elif c and c in "wWsSbB123456789":
+                ret.append("\\" + c)
+            elif c and c not in "`'":
+                ret.append(re.escape(c))
+            else:
+                return None
+        elif c == "[":
+            translation, pos = translate_bracket(pattern, pos)
+            if translation is None:
+                return None
+            ret.append(translation)
+        elif c == "(" and pattern.startswith("?", pos + 1):
+            return None  # Python extension syntax
+        else:
+            ret.append(c)
+            pos += 1
+    return "".join(ret)
+
+def parse_grep_args(grepargs):
+    """Return a map of the options for `search_file` specified by the
+    `egrep` arguments `grepargs`, or `None` if the built-in search engine
+    does not support them.  The pattern is translated to Python syntax; a
+    pattern that cannot be, or is invalid, is also left to `egrep`, which
+    reports any error."""
+    options = { "pattern" : None, "ignore_case" : False, "word" : False,
+                "files_only" : False, "line_numbers" : False,
+                "with_filename" : None, "before" : 0, "after" : 0 }
+    args = iter(grepargs)
+    for arg in args:
+        if arg == "-" or not arg.startswith("-"):
+            if options["pattern"] is not None:
+                return None  # Extra file arguments
+            options["pattern"] = arg
+            continue
+        if arg.startswith("--"):
+            return None
+        flags = arg[1:]
+        while flags:
+            flag, flags = flags[0], flags[1:]
+            if flag in "ABCe":
+                value = flags or next(args, None)
+                flags = ""
+                if value is None:
+                    return None
+                if flag == "e":
+                    if options["pattern"] is not None:
+                        return None  # Multiple patterns
+                    options["pattern"] = value
+                    continue
+                if not value.isdigit():
+                    return None
+                if flag in "AC":
+                    options["after"]  = int(value)
+                if flag in "BC":
+                    options["before"] = int(value)
+            elif flag == "i":
+                options["ignore_case"] = True
+            elif flag == "w":
+                options["word"] = True
+            elif flag == "l":
+                options["files_only"] = True
+            elif flag == "n":
+                options["line_numbers"] = True
+            elif flag in "hH":
+                options["with_filename"] = flag == "H"
+            elif flag != "E":
+                return None
+    if options["pattern"] is None:
+        return None
+    pattern = translate_ere(options["pattern"])
+    if pattern is None:
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            re.compile(pattern.encode("utf-8", "surrogateescape"))
+    except (re.error, FutureWarning):
+        return None
+    options["pattern"] = pattern
+    return options
+
+def init_search(options):
+    """Set the options used by `search_file` in this process, compiling the
+    pattern"""
+    global search_options
+    flags   = re.MULTILINE | (re.IGNORECASE if options["ignore_case"] else 0)
+    pattern = options["pattern"].encode("utf-8", "surrogateescape")
+    search_options = dict(options, regex=re.compile(pattern, flags),
+                          line_regex=re.compile(pattern, flags))
+    if options["word"]:
+        # Leading look-behind assertions stop the regex engine from skipping
+        # ahead to a literal prefix, so the unadorned pattern is used to find
+        # candidate lines, which are then checked with this one.
+        search_options["line_regex"] = \
+            re.compile(rb"(?<!\w)(?:" + pattern + rb")(?!\w)", flags)
+
+def search_content(content, name):
+    """Return the list of groups of output lines (each group a `bytes`)
+    for the lines of `content` that match, in `egrep` format, where `name`
+    is the file name (as `bytes`) to show, if any"""
+    regex      = search_options["regex"]
+    line_regex = search_options["line_regex"]
+    before     = search_options["before"]
+    after      = search_options["after"]
+    end        = len(content)
+
+    # Find the start of each matching line
+    matches = []
+    pos     = 0
+    while pos < end:
+        match = regex.search(content, pos)
+        if match is None:
+            break
+        line_start = content.rfind(b"\n", 0, match.start()) + 1
+        line_end   = content.find(b"\n", line_start)
+        if line_end < 0:
+            line_end = end
+        if (line_regex is regex and match.end() <= line_end) or \
+           line_regex.search(content, line_start, line_end):
+            if search_options["files_only"]:
+                return [name + b"\n"]
+            matches.append(line_start)
+        # else the match spanned lines, which a `grep` match cannot, or was
+        # not a whole word
+        pos = line_end + 1
+
+    groups       = []
+    group        = []
+    printed_end  = None  # Offset just past the last line output
+    counted_pos  = 0     # `line_number` is the number of the line here
+    line_number  = 1
+
+    def emit(line_start, separator):
+        """Output the line at `line_start` and return the offset of the
+        next line"""
+        nonlocal counted_pos, line_number
+        line_end = content.find(b"\n", line_start)
+        if line_end < 0:
+            line_end = end
+        prefix = name + separator if name else b""
+        if search_options["line_numbers"]:
+            line_number += content[counted_pos:line_start].count(b"\n")
+            counted_pos  = line_start
+            prefix      += b"%d%s" % (line_number, separator)
+        group.append(prefix + content[line_start:line_end] + b"\n")
+        return line_end + 1
+
+    for line_start in matches:
+        if printed_end is not None and after:
+            # Trailing context of the previous match
+            for count in range(after):
+                if printed_end >= line_start:
+                    break
+                printed_end = emit(printed_end, b"-")
+        context_start = line_start
+        for count in range(before):
+            if context_start == 0 or context_start == printed_end:
+                break
+            context_start = content.rfind(b"\n", 0, context_start - 1) + 1
+        if (printed_end is not None and context_start > printed_end and
+            (before or after)):
+            groups.append(b"".join(group))  # Not contiguous with this one
+            group = []
+        while context_start < line_start:
+            context_start = emit(context_start, b"-")
+        printed_end = emit(line_start, b":")
+    if printed_end is not None:
+        for count in range(after):
+            if printed_end >= end:
+                break
+            printed_end = emit(printed_end, b"-")
+        groups.append(b"".join(group))
+    return groups
+
+def search_file(file_name):
+    """Return the list of groups of output lines for `file_name`, as for
+    `search_content`"""
+    name = b""
+    if search_options["with_filename"] or search_options["files_only"]:
+        name = os.fsencode(file_name)
+    with open(file_name, "rb") as file:
+        if os.fstat(file.fileno()).st_size < mmap_threshold:
+            # Mapping a small file costs more than reading it
+            return search_content(file.read(), name)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return search_content(content, name)
+
+def matrix_closures(configs, headers):
+    """Return a list of `(label, files, closure_id)` tuples, one for each
+    `(compiler, std)` pair in `configs` whose `header_closure` (computed
+    concurrently) of `headers` could be found, in the order of `configs`"""
+    def closure(config):
+        try:
+            return header_closure(*config, headers)
+        except closure_error as e:
+            if e.args[0] is not None:
+                print(f"{sys.argv[0]}: {e.args[0]}", file=sys.stderr)
+            print(f"{sys.argv[0]}: skipping {config[0]}/{config[1]}",
+                  file=sys.stderr)
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        results = list(executor.map(closure, configs))
+    return [(f"{compiler}/{std}", *result)
+            for (compiler, std), result in zip(configs, results)
+            if result is not None]
+
+def dedupe_files(closures):
+    """Return the tuple `(files, labels)` for the specified `closures` (as
+    returned by `matrix_closures`), where `files` lists each distinct file
+    once, in order of first appearance, and `labels[i]` is the tuple of the
+    labels of the closures containing `files[i]`.  Files are the same if they
+    are the same inode or, failing that, have the same contents; only files
+    having the same size as another are hashed."""
+    files     = []
+    labels    = []
+    sizes     = []
+    by_inode  = { }
+    for label, closure_files, closure_id in closures:
+        for file_name in closure_files:
+            stat = os.stat(file_name)
+            i    = by_inode.setdefault((stat.st_dev, stat.st_ino), len(files))
+            if i == len(files):
+                files.append(file_name)
+                labels.append([])
+                sizes.append(stat.st_size)
+            if label not in labels[i]:
+                labels[i].append(label)
+
+    by_size = { }
+    for i, size in enumerate(sizes):
+        by_size.setdefault(size, []).append(i)
+    duplicate_of = { }
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+        by_digest = { }
+        for i in same_size:
+            with open(files[i], "rb") as file:
+                digest = hashlib.blake2b(file.read()).digest()
+            first = by_digest.setdefault(digest, i)
+            if first != i:
+                duplicate_of[i] = first
+
+    order = [label for label, closure_files, closure_id in closures]
+    for i, first in duplicate_of.items():
+        labels[first] = sorted(set(labels[first] + labels[i]),
+                               key=order.index)
+    return ([file_name for i, file_name in enumerate(files)
+             if i not in duplicate_of],
+            [tuple(file_labels) for i, file_labels in enumerate(labels)
+             if i not in duplicate_of])
+
+def label_tag(file_labels):
+    """Return the output prefix for a file in the closures having the
+    specified `file_labels`"""
+    return ("[" + ",".join(file_labels) + "] ").encode()
+
+def search_files(options, files, tags = None, output = None):
+    """Search `files` with the built-in engine, using a process pool, and
+    write the results to the binary `output` (by default, `stdout`) in file
+    order, prefixing each line of output for `files[i]` with `tags[i]` if
+    `tags` is specified.  Return the `egrep` exit status: 0 if any line
+    matched and 1 otherwise."""
+    if options["with_filename"] is None:
+        options = dict(options, with_filename=len(files) > 1)
+    executor = None
+    if jobs > 1 and len(files) >= 4 * jobs:
+        executor = ProcessPoolExecutor(max_workers=jobs,
+                                       initializer=init_search,
+                                       initargs=(options,))
+        results  = executor.map(search_file, files,
+                                chunksize=max(1, len(files) // (jobs * 8)))
+    else:
+        init_search(options)
+        results = map(search_file, files)
+
+    output  = output or sys.stdout.buffer
+    matched = False
+    try:
+        for file_number, groups in enumerate(results):
+            for group in groups:
+                if matched and (options["before"] or options["after"]):
+                    output.write(b"--\n")
+                if tags is not None:
+                    group = b"".join(tags[file_number] + line for line in
+                                     group.splitlines(keepends=True))
+                output.write(group)
+                matched = True
+    finally:
+        if executor is not None:
+            # Do not finish the search if the output has gone away
+            executor.shutdown(cancel_futures=True)
+    output.flush()
+    return 0 if matched else 1
+
+def run_egrep(grepargs, files, tag = None, output = None):
+    """Run `egrep` with `grepargs` on `files`, in batches small enough to
+    stay within the limit on the size of the argument list, and return its
+    exit status.  If `tag` is specified, file names are always shown and
+    each line of output is prefixed with `tag`.  If `output` is specified,
+    the output is written to it rather than to `stdout`."""
+    # Leave room for the environment and the other arguments
+    limit   = min(os.sysconf("SC_ARG_MAX") // 2, 128 * 1024) - \
+              sum(len(arg) + 1 for arg in grepargs)
+    command = ["egrep"] + (["-H"] if len(files) > 1 or tag is not None
+                           else []) + grepargs
+    batches = [[]]
+    size    = 0
+    for file_name in files:
+        if batches[-1] and size + len(file_name) + 1 > limit:
+            batches.append([])
+            size = 0
+        batches[-1].append(file_name)
+        size += len(file_name) + 1
+
+    statuses = []
+    for batch in batches:
+        if tag is None and output is None:
+            statuses.append(sp.run(command + batch).returncode)
+            continue
+        result = sp.run(command + batch, stdout=sp.PIPE)
+        # Context separators are not tagged, as in `search_files`
+        (output or sys.stdout.buffer).write(b"".join(
+            line if line == b"--\n" else (tag or b"") + line
+            for line in result.stdout.splitlines(keepends=True)))
+        sys.stdout.buffer.flush()
+        statuses.append(result.returncode)
+    return 0 if 0 in statuses else max(statuses)
+
+def check_engines(grepargs, options, files, tags, candidates):
+    """Search `files` with both `egrep` and the built-in engine, which
+    searches only the `candidates` chosen by the index, write the output of
+    `egrep` to `stdout`, and report any difference between the two.  Return
+    the `egrep` exit status, or 3 if the engines disagree."""
+    groups = { }  # Map tag to files, as searched by `egrep`
+    for file_number, file_name in enumerate(files):
+        groups.setdefault(None if tags is None else tags[file_number],
+                          []).append(file_name)
+    candidates = set(candidates)
+    statuses   = []
+    agree      = True
+    for tag, group_files in groups.items():
+        egrep_output   = io.BytesIO()
+        builtin_output = io.BytesIO()
+        egrep_status   = run_egrep(grepargs, group_files, tag, egrep_output)
+        builtin_files  = [file_name for file_name in group_files
+                          if file_name in candidates]
+        builtin_status = search_files(
+            options, builtin_files,
+            None if tag is None else [tag] * len(builtin_files),
+            builtin_output)
+        sys.stdout.buffer.write(egrep_output.getvalue())
+        statuses.append(egrep_status)
+        if (egrep_status, egrep_output.getvalue()) == \
+           (builtin_status, builtin_output.getvalue()):
+            continue
+        agree = False
+        print(f"{sys.argv[0]}: egrep (status {egrep_status}) and the "
+              f"built-in engine (status {builtin_status}) disagree:",
+              file=sys.stderr)
+        sys.stderr.writelines(difflib.unified_diff(
+            egrep_output.getvalue().decode(errors="replace")
+            .splitlines(keepends=True),
+            builtin_output.getvalue().decode(errors="replace")
+            .splitlines(keepends=True), "egrep", "built-in"))
+    sys.stdout.buffer.flush()
+    if not agree:
+        return 3
+    return 0 if 0 in statuses else max(statuses)
+
+def main():
+    global compilers
+    global stds
+    global jobs
+    global use_egrep
+    global use_index
+    global check_egrep
+    args = sys.argv[1:]
+    while args and (args[0].startswith(("--cxx=", "--std=", "--jobs=")) or
+                    args[0] in ("--egrep", "--index", "--check-egrep")):
+        option, value = (args.pop(0) + "=").split("=", 1)
+        if option == "--cxx":
+            compilers += value[:-1].split(",")
+        elif option == "--std":
+            stds += value[:-1].split(",")
+        elif option == "--index":
+            use_index = True
+        elif option == "--check-egrep":
+            check_egrep = True
+        elif option == "--jobs":
+            if not value[:-1].isdigit():
+                usage("--jobs requires a numeric argument")
+                return 1
+            jobs = int(value[:-1])
+        else:
+            use_egrep = True
+
+    if len(args) < 2:
+        usage("Not enough command-line arguments")
+        return 1
+
+    # The header file name is the last command-line argument unless there is
+    # a "--" in the command line, in which case the header file is all of the
+    # arguments following the "--".  The grep arguments are all of the
+    # arguments up to the first header argument (excluding any "--").
+    if "--" in args:
+        dd_index = args.index("--")
+        grepargs = args[:dd_index]
+        headers  = args[dd_index+1:]
+    else:
+        grepargs = args[:-1]
+        headers  = args[-1:]
+
+    configs = [(compiler, std) for compiler in compilers or ["g++-11"]
+               for std in stds or ["c++20"]]
+    tags    = None
+    if len(configs) == 1:
+        try:
+            grepfiles, closure_id = header_closure(*configs[0], headers)
+        except closure_error as e:
+            if e.args[0] is not None:
+                print(e.args[0], file=sys.stderr)
+            return e.status
+    else:
+        closures = matrix_closures(configs, headers)
+        if not closures:
+            return 2
+        grepfiles, file_labels = dedupe_files(closures)
+        tags       = [label_tag(labels) for labels in file_labels]
+        closure_id = hashlib.blake2b(
+            " ".join(closure_id for label, files, closure_id in closures)
+            .encode(), digest_size=8).hexdigest()
+
+    options = None if use_egrep else parse_grep_args(grepargs)
+    if options is None:
+        if tags is None:
+            return run_egrep(grepargs, grepfiles)
+        # Run `egrep` once for each set of configurations
+        files_by_tag = { }
+        for file_name, tag in zip(grepfiles, tags):
+            files_by_tag.setdefault(tag, []).append(file_name)
+        statuses = [run_egrep(grepargs, files, tag)
+                    for tag, files in files_by_tag.items()]
+        return 0 if 0 in statuses else max(statuses)
+    if options["with_filename"] is None:
+        # Narrowing the files must not change the output format, and tagged
+        # output is meaningless without file names
+        options["with_filename"] = len(grepfiles) > 1 or tags is not None
+    candidates = grepfiles
+    if use_index:
+        index = trigram_index(closure_id, grepfiles)
+        if not index.load():
+            index.build()
+            index.save()
+        candidates = index.candidates(options["pattern"])
+    if check_egrep:
+        return check_engines(grepargs, options, grepfiles, tags, candidates)
+    if tags is not None and candidates is not grepfiles:
+        tag_of = dict(zip(grepfiles, tags))
+        tags   = [tag_of[file_name] for file_name in candidates]
+    return search_files(options, candidates, tags)
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # The reader of the output (e.g., `head`) has exited; stop quietly,
+        # as `egrep` does, with the status of a process killed by `SIGPIPE`.
+        # Pointing `stdout` at /dev/null stops the flush at exit failing.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(128 + signal.SIGPIPE)
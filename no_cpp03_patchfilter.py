@@ -1,20 +1,149 @@
 #! /usr/bin/env python3
 
+# Usage: no_cpp03_patchfilter.py [--exclude <glob>] [--include <glob>]...
+#
 # stdin = patch file
-# stdout = patch file without _cpp03.* diffs
+# stdout = patch file without the diffs of excluded files
+#
+# Each `diff --git` section is kept or dropped according to the path(s) it
+# names.  The `--exclude` and `--include` rules are applied in order and the
+# last rule whose glob matches either path decides; sections matching no rule
+# are kept.  Globs are matched against the whole path, and `*` also matches
+# `/`.  Without any rules, the default is `--exclude '*_cpp03.*'`, i.e., drop
+# the diffs of the generated C++03 compatibility files.
+#
+# The patch is processed as binary data in large blocks, so arbitrary
+# encodings pass through unchanged and multi-hundred-MB patches are copied
+# at close to the speed of the pipe.
 
 import sys
+import os
 import re
+import fnmatch
 
-doprint = True
+default_rules = [ ("exclude", "*_cpp03.*") ]
 
-diffStart = re.compile(r"^diff --git ")
-diffStart_cpp03 = re.compile(r"^diff --git .*_cpp03\.")
+diff_start = b"diff --git "
+block_size = 1 << 20
 
-for line in sys.stdin:
-    if diffStart_cpp03.match(line):
-        doPrint = False
-    elif diffStart.match(line):
-        doPrint = True
-    if doPrint:
-        print(line, end='')
+def usage(error_str = None):
+    if error_str is not None:
+        print(error_str, file=sys.stderr)
+    print("Usage: no_cpp03_patchfilter.py [--exclude <glob>] "
+          "[--include <glob>]... < patch > filtered-patch", file=sys.stderr)
+    sys.exit(2)
+
+def compile_rules(rules):
+    """Return a function that takes a list of paths and returns whether a
+    diff section for those paths should be kept under the specified `rules`,
+    a list of `(action, glob)` pairs.  All globs are compiled into a single
+    regular expression, with later rules tried first."""
+    if not rules:
+        return lambda paths: True
+    alternatives = [f"(?P<rule{index}>{fnmatch.translate(glob)})"
+                    for index, (action, glob) in reversed(list(
+                        enumerate(rules)))]
+    matcher = re.compile("|".join(alternatives))
+
+    def keep(paths):
+        matches = [matcher.match(path) for path in paths]
+        last = max((int(m.lastgroup[4:]) for m in matches if m), default=None)
+        return last is None or rules[last][0] == "include"
+    return keep
+
+def unquote(path):
+    """Return the specified `path` from a `diff --git` header with any C-style
+    quoting, which git uses for unusual file names, removed."""
+    if not path.startswith(b'"'):
+        return path
+    return path[1:-1].decode('unicode_escape').encode('latin-1')
+
+def header_paths(header):
+    """Return the list of paths, without their `a/` and `b/` prefixes, named by
+    the specified `diff --git` header line."""
+    rest = header[len(diff_start):].rstrip(b"\r\n")
+    if rest.startswith(b'"'):
+        end = rest.find(b'" ', 1)
+        names = [rest[:end + 1], rest[end + 2:]] if end > 0 else [rest]
+    else:
+        # An unquoted path can contain " b/"; prefer the split giving two
+        # equal paths, as it does for anything but a rename.
+        half = (len(rest) - 1) // 2
+        if rest[half:half + 3] == b" b/" and rest[2:half] == rest[half + 3:]:
+            names = [rest[:half], rest[half + 1:]]
+        else:
+            names = rest.split(b" b/", 1)
+            if len(names) == 2:
+                names[1] = b"b/" + names[1]
+    paths = []
+    for name in map(unquote, names):
+        if name[:2] in (b"a/", b"b/"):
+            name = name[2:]
+        paths.append(os.fsdecode(name))
+    return paths
+
+def filter_patch(infile, outfile, keep):
+    """Copy the patch read from the binary `infile` to the binary `outfile`,
+    dropping each `diff --git` section for whose paths `keep` returns false.
+    Text before the first section is always copied."""
+    marker  = b"\n" + diff_start
+    keeping = True
+    # `data[:pos]` has been dealt with, and `data[search:]` may hold `marker`.
+    # Only the tail of the last line of a block is carried over to the next,
+    # with the line break before it so that a header is always preceded by
+    # one (a notional one at the very start).
+    data   = b"\n"
+    pos    = 1
+    search = 0
+    while True:
+        block = infile.read(block_size)
+        data += block
+        view = memoryview(data)
+        while True:
+            header = data.find(marker, search)
+            if header < 0:
+                break
+            header += 1
+            if keeping and header > pos:
+                outfile.write(view[pos:header])
+            pos = header
+            eol = data.find(b"\n", header)
+            if eol < 0:
+                if block:
+                    search = header - 1  # Incomplete; wait for more data
+                    break
+                eol = len(data)
+            keeping = keep(header_paths(data[header:eol]))
+            if keeping:
+                outfile.write(view[header:eol])
+            pos = search = eol
+        if not block:
+            if keeping:
+                outfile.write(view[pos:])
+            return
+        tail = data.rfind(b"\n", search)
+        if tail < 0:
+            tail = len(data) - 1
+        if keeping and tail > pos:
+            outfile.write(view[pos:tail])
+        view.release()
+        data   = data[tail:]
+        pos    = max(pos - tail, 0)
+        search = 0
+
+if __name__ == "__main__":
+    rules = []
+    args  = iter(sys.argv[1:])
+    for arg in args:
+        option, eq, value = arg.partition("=")
+        if option in ("--exclude", "--include"):
+            if not eq:
+                value = next(args, None)
+                if value is None:
+                    usage(f"{option} requires a glob argument")
+            rules.append((option[2:], value))
+        else:
+            usage(f"Invalid argument: {arg}")
+
+    keep = compile_rules(rules or default_rules)
+    filter_patch(sys.stdin.buffer, sys.stdout.buffer, keep)
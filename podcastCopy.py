@@ -1,18 +1,215 @@
 #! /usr/local/bin/python3
 
+# Usage: podcastCopy.py [--jobs <n>] <file.mp3>...
+#
+# Copy each `.mp3` file to `sortedDir`, prefixing its name with a 3-digit
+# sequence number taken from `counter.txt` in the file's directory.  The
+# numbers for all the files from one directory are reserved in a single
+# locked update of `counter.txt`, in command-line order, so concurrent runs
+# never reuse a number.  Up to `--jobs` files (default: 4) are copied at once.
+#
+# Each copy is recorded in `copied-index.json` next to `counter.txt`, with the
+# file's size, modification time and content hash, so running the script
+# again over the same directory skips the episodes already copied.  A file
+# whose size and modification time match its entry is skipped without being
+# read; otherwise it is hashed and skipped if any copied file had the same
+# content.
+
 import sys
+import os
 import os.path as path
 import shutil
+import errno
+import fcntl
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# sortedDir = path.join(dir, "Sorted Podcasts")
+sortedDir = "/Volumes/K7"
+jobs = 4
+chunkSize = 1 << 24
+indexVersion = 1
+
+def loadIndex(indexFilename):
+    """Return the map from file name to `{"size", "mtime_ns", "hash",
+    "copy"}` stored in `indexFilename`, or an empty map if there is no usable
+    index."""
+    try:
+        with open(indexFilename) as indexFile:
+            index = json.load(indexFile)
+        if index.get("version") == indexVersion:
+            return index["files"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+def updateIndex(dir, entries):
+    """Merge `entries` into the index in `dir`, holding the lock on its
+    `counter.txt` so that concurrent runs do not lose each other's entries."""
+    indexFilename = path.join(dir, "copied-index.json")
+    with open(path.join(dir, "counter.txt")) as counterFile:
+        fcntl.flock(counterFile, fcntl.LOCK_EX)
+        files = loadIndex(indexFilename)
+        files.update(entries)
+        tmpFilename = f"{indexFilename}.{os.getpid()}.tmp"
+        with open(tmpFilename, "w") as indexFile:
+            json.dump({ "version" : indexVersion, "files" : files },
+                      indexFile, indent=1, sort_keys=True)
+        os.replace(tmpFilename, indexFilename)
 
-for filename in sys.argv:
-    (dir, base) = path.split(filename)
-    if base[-4:] != ".mp3": continue
-    # sortedDir = path.join(dir, "Sorted Podcasts")
-    sortedDir = "/Volumes/K7"
-    counterFilename = path.join(dir, "counter.txt");
+def hashFile(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as file:
+        while block := file.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+def indexEntry(stat, hash, copyName):
+    return { "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns,
+             "hash" : hash, "copy" : copyName }
+
+def reserveCounts(counterFilename, n):
+    """Atomically advance the counter in `counterFilename` by `n` and return
+    its old value, the first of the `n` reserved numbers."""
     with open(counterFilename, "r+") as counterFile:
+        fcntl.flock(counterFile, fcntl.LOCK_EX)
         count = int(counterFile.read())
         counterFile.seek(0)
-        counterFile.write(str(count + 1))
-    copyFilename = path.join(sortedDir, f"{count:0>3}.{base}",)
-    shutil.copyfile(filename, copyFilename)
+        counterFile.write(str(count + n))
+        counterFile.truncate()
+        counterFile.flush()
+        os.fsync(counterFile.fileno())
+    return count  # Closing the file released the lock
+
+def copyFile(filename, copyFilename):
+    """Copy the contents of `filename` to `copyFilename` in the kernel where
+    the platform allows (`copy_file_range`, else `sendfile`), otherwise
+    through a user-space buffer, and return the number of bytes copied."""
+    with open(filename, "rb") as src, open(copyFilename, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        for copier in (getattr(os, "copy_file_range", None),
+                       getattr(os, "sendfile", None)):
+            if copier is None:
+                continue
+            copied = 0
+            try:
+                while copied < size:
+                    if copier is os.sendfile:
+                        n = copier(dst.fileno(), src.fileno(), copied,
+                                   chunkSize)
+                    else:
+                        n = copier(src.fileno(), dst.fileno(), chunkSize,
+                                   copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                # Unsupported for this pair of files; try something else
+                if copied or e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                             errno.EINVAL, errno.ENOTSUP,
+                                             errno.EBADF, errno.ENOTSOCK):
+                    raise
+                continue
+            if copied == size:
+                return copied
+            if copied:
+                break  # Finish the short copy through the buffer below
+        # The kernel copiers use explicit offsets, so position both files
+        src.seek(copied)
+        dst.seek(copied)
+        dst.truncate()
+        shutil.copyfileobj(src, dst, chunkSize)
+        if dst.tell() != size:
+            raise OSError(errno.EIO, f"copied {dst.tell()} of {size} bytes",
+                          filename)
+        return dst.tell()
+
+def timedCopy(filename, copyFilename):
+    start = time.monotonic()
+    size = copyFile(filename, copyFilename)
+    return size, time.monotonic() - start
+
+def rate(size, seconds):
+    return f"{size / 1e6:.1f} MB in {seconds:.2f} s " \
+        f"({size / 1e6 / max(seconds, 1e-6):.1f} MB/s)"
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--jobs"] or args[:1] == ["-j"]:
+        if len(args) < 2 or not args[1].isdigit() or int(args[1]) == 0:
+            print("--jobs requires a positive numeric argument",
+                  file=sys.stderr)
+            sys.exit(2)
+        jobs = int(args[1])
+        args = args[2:]
+
+    # Group the episodes by directory, keeping command-line order
+    episodes = {}
+    for filename in args:
+        (dir, base) = path.split(filename)
+        if base[-4:] != ".mp3": continue
+        episodes.setdefault(dir, []).append(filename)
+
+    copies = []
+    copyEntries = []  # `(dir, base, index entry)` for each of `copies`
+    newEntries = {}   # Map of directory to index entries to add
+    for dir, filenames in episodes.items():
+        files = loadIndex(path.join(dir, "copied-index.json"))
+        byHash = { entry["hash"] : entry["copy"] for entry in files.values() }
+        entries = newEntries.setdefault(dir, {})
+        toCopy = []
+        for filename in filenames:
+            base = path.basename(filename)
+            stat = os.stat(filename)
+            entry = files.get(base)
+            if (entry and entry["size"] == stat.st_size and
+                    entry["mtime_ns"] == stat.st_mtime_ns):
+                print(f"{filename}: already copied as {entry['copy']}")
+                continue
+            hash = hashFile(filename)
+            if hash in byHash:
+                print(f"{filename}: already copied as {byHash[hash]}")
+                entries[base] = indexEntry(stat, hash, byHash[hash])
+                continue
+            if any(hash == toCopyHash for _, _, toCopyHash in toCopy):
+                print(f"{filename}: duplicate of an earlier file")
+                continue
+            toCopy.append((filename, stat, hash))
+        if not toCopy:
+            continue
+
+        counterFilename = path.join(dir, "counter.txt");
+        count = reserveCounts(counterFilename, len(toCopy))
+        for filename, stat, hash in toCopy:
+            base = path.basename(filename)
+            copyName = f"{count:0>3}.{base}"
+            copies.append((filename, path.join(sortedDir, copyName)))
+            copyEntries.append((dir, base, indexEntry(stat, hash, copyName)))
+            count += 1
+
+    status = 0
+    total = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(timedCopy, *copy) for copy in copies]
+        # Report in the order the numbers were assigned
+        for (filename, copyFilename), (dir, base, entry), future in zip(
+                copies, copyEntries, futures):
+            try:
+                size, seconds = future.result()
+            except OSError as e:
+                print(f"{filename}: {e}", file=sys.stderr)
+                status = 1
+                continue
+            newEntries[dir][base] = entry
+            total += size
+            print(f"{copyFilename}: {rate(size, seconds)}")
+    for dir, entries in newEntries.items():
+        if entries:
+            updateIndex(dir, entries)
+    if len(copies) > 1:
+        print(f"{len(copies)} files: {rate(total, time.monotonic() - start)}")
+    sys.exit(status)
@@ -1,8 +1,13 @@
 #! /usr/bin/python3
 
-# Usage: renumber_tests.py <filename>
+# Usage: renumber_tests.py [--check] [--jobs <n>] <filename|directory>...
 #
-# The specified file must be in the form of a BDE test driver. Tests are
+# Each specified file must be in the form of a BDE test driver; each specified
+# directory is searched recursively for test drivers (`*.t.cpp`, `*.xt.cpp` and
+# numbered `*.N.t.cpp` files).  Many drivers are processed in parallel by a
+# pool of `--jobs` processes (default: one per CPU), and a summary is printed
+# at the end.  With `--check`, nothing is written; the exit status is 1 if any
+# driver would be renumbered (and 2 if any could not be processed).  Tests are
 # renumbered in decending order of appearance.  Negative-numbered tests are not
 # renumbered.  The table of contents at the begining of the test plan is
 # modified to correspond to the renumbering; if a test is removed, any
@@ -23,89 +28,169 @@
 import sys
 import os
 import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 # Regular expressions, compiled for efficiency
-c_comment_re   = re.compile(r'/\*[^*]*\*+(?:[^/*][^*]*\*+)*/', flags=re.DOTALL)
-cpp_comment_re = re.compile(r'//.*')
 main_re        = re.compile(r'^ *int *main\b')
 switch_re      = re.compile(r'^ +switch *\(')
 # Note that `case_re` ignores negative case numbers
-case_re        = re.compile(r'^ +case +([1-9A-Za-z][0-9A-Za-z]*) *:')
-planitem_re    = re.compile(r'^// +\[ *([1-9A-Za-z][0-9A-Za-z]*)\]')
+case_re        = re.compile(r'^ +case +([1-9A-Za-z][0-9A-Za-z]*) *:',
+                            flags=re.MULTILINE)
+planitem_re    = re.compile(r'^// +\[ *([1-9A-Za-z][0-9A-Za-z]*)\]',
+                            flags=re.MULTILINE)
+first_line_re  = re.compile(r'(?P<line>)(?= *(?:case|switch|int|/\*))')
+c_comment_re   = re.compile(r'/\*.*?(?:\*/|$)')
+test_driver_re = re.compile(r'\.([0-9]+\.)?x?t\.cpp$')
 
-def remove_comments(code):
-    """Remove comments from the specifed multiline `code` and return the same
-    code without comments.  Line breaks are preserved so that there remains
-    a 1:1 correspondence between lines in the input and lines in the output."""
+# The tokens that matter for finding test cases: runs of code within a line
+# that start with a brace, lines that may start with `int main`, `switch`,
+# `case` or a comment, and the comments and literals that span lines.
+# Everything else, including literals and comments within a line, is skipped
+# without backtracking: a lookahead that captures a run, followed by a
+# backreference that consumes it, is an atomic group that also works before
+# Python 3.11.  A quote between hex digits is a digit separator (`1'000`), not
+# a literal.
+token_re = re.compile(r"""
+    (?= (?P<skip>
+      (?: [^\n{}/"'R]+
+        | \n(?!\ *(?:case|switch|int|/\*))
+        | //[^\n]*
+        | /\*[^\n]*?\*/
+        | /(?![/*])
+        | R(?!")
+        | "[^"\\\n]*(?:\\[^\n][^"\\\n]*)*"
+        | '[^'\\\n]*(?:\\[^\n][^'\\\n]*)*'
+        | (?<=[0-9A-Fa-f])(?<!u8)'(?=[0-9A-Fa-f])
+      )* ) ) (?P=skip)
+    (?: (?P<line> \n )
+      | (?P<braces> [{}]
+                    (?= (?P<code> (?: [^\n"'/R]+ | /(?![/*]) | R(?!") )* ) )
+                    (?P=code) )
+      | (?P<comment> /\*.*?(?:\*/|\Z) )
+      | (?P<literal> R"(?P<delim>[^()\\\s"]{0,16})\(.*?(?:\)(?P=delim)"|\Z)
+                   | "[^"\\\n]*(?:\\.[^"\\\n]*)*"?
+                   | '[^'\\\n]*(?:\\.[^'\\\n]*)*'? )
+      | R
+      | (?P<end> \Z )
+    )
+""", flags=re.DOTALL | re.VERBOSE)
 
-    # Remove all multi-line comments, preserving line breaks
-    code = c_comment_re.sub(lambda m: re.sub(r'[^\n]+', '', m[0]), code)
-    # Replace all single-line comments with spaces
-    code = cpp_comment_re.sub('', code)
-    return code
+def stripped_line(code, start, text_start):
+    """Return the line of the specified `code` beginning at `start`, keeping
+    only the part from `text_start` onwards with any `/* */` comments in it
+    removed."""
+    end = code.find('\n', text_start)
+    if end < 0:
+        end = len(code)
+    text = code[text_start:end]
+    if '/*' in text:
+        text = c_comment_re.sub('', text)
+    return code[start:text_start] + text
 
 def find_case_lines(code):
-    """Return a list of tuples, `(line-index`, case-label)`, for each top-level
+    """Return a list of tuples, `(line-start, case-label)`, for each top-level
     case statement in the top-level switch statement within `main`.  The
-    line-index is the index into the array of lines == one less than the line
-    number.  The case-label is a string that contains either an integer (for an
-    old test case) or an alphanumeric identifier (for a new test cast).  The
-    returned tuples are sorted in increasing order of line index
+    line-start is the offset within `code` of the line holding the case.  The
+    case-label is a string that contains either an integer (for an old test
+    case) or an alphanumeric identifier (for a new test cast).  The returned
+    tuples are sorted in increasing order of line start.  Raise `ValueError`
+    if the switch statements in `main` are unbalanced.
+
+    The code is lexed in a single pass, skipping comments and literals, so
+    that only lines that may start with `int main`, `switch` or `case`, and
+    runs of code containing braces, are examined.
     """
 
     cases = []
-    lines = remove_comments(code).split('\n')
 
     in_main = False
     brace_depth    = 0   # Current depth of braces
     switch_nesting = 0   # To handle nested switches
     switch_depth   = 0   # Brace depth of current switch
     switch_stack   = [ ] # Stack of switch depths
+    closing_line_end = -1  # End of the last line seen to have a "}"
 
-    for lineidx, line in enumerate(lines):
-
-        if brace_depth == 0 and main_re.match(line):
-            in_main = True
+    tokens = token_re.finditer(code)
+    first_line = first_line_re.match(code)
+    if first_line:
+        tokens = itertools.chain([first_line], tokens)
 
-        if not in_main:
+    for m in tokens:
+        kind = m.lastgroup
+        if kind == 'line':
+            pos  = m.end()
+            line = stripped_line(code, pos, pos)
+        elif kind == 'braces':
+            pos  = m.start(kind)
+            line = m[kind]
+        elif kind in ('comment', 'literal'):
+            start, end = m.span(kind)
+            pos = code.rfind('\n', start, end) + 1
+            if pos == 0:
+                continue
+            # A line begins inside this token; what follows the token is the
+            # start of that line as far as `main`, `switch` and `case` are
+            # concerned.
+            kind = 'line'
+            line = stripped_line(code, end, end)
+        elif kind == 'end':
+            pos = len(code) + 1
+        else:
             continue
 
-        if switch_re.match(line):
-            switch_stack.append(switch_depth) # Save old depth
-            switch_depth = brace_depth  # Depth *before* switch
-            switch_nesting += 1  # Increment nesting level
+        if 0 <= closing_line_end < pos:
+            closing_line_end = -1
+
+            if switch_nesting > 0 and brace_depth <= switch_depth:
+                switch_nesting -= 1
+                switch_depth = switch_stack.pop()
+
+            # Exit main if braces close up
+            if brace_depth <= 0:
+                if switch_nesting != 0:
+                    raise ValueError("unbalanced switch statements in main")
+                # Because of conditional compilation, there could be more
+                # than one `main`, e.g., there could be stubbed out `main` for
+                # certain build modes.  Return the cases from the first `main`
+                # that has a switch statement.
+                if cases:
+                    return cases
+                else:
+                    in_main = False
+
+        if kind == 'line':
+            if brace_depth == 0 and main_re.match(line):
+                in_main = True
 
-        # Only consider cases at the first switch level
-        if switch_nesting == 1:
-            case_match = case_re.match(line)
-            if case_match:
-                cases.append(( lineidx, case_match[1] ))
+            if not in_main:
+                continue
+
+            if switch_re.match(line):
+                switch_stack.append(switch_depth) # Save old depth
+                switch_depth = brace_depth  # Depth *before* switch
+                switch_nesting += 1  # Increment nesting level
+
+            # Only consider cases at the first switch level
+            if switch_nesting == 1:
+                case_match = case_re.match(line)
+                if case_match:
+                    cases.append(( pos, case_match[1] ))
 
         # Count braces to determine scope
-        brace_depth += line.count('{')
-        closed_count = line.count('}')
-        brace_depth -= closed_count
-
-        if switch_nesting > 0 and closed_count > 0 and brace_depth <= switch_depth:
-            switch_nesting -= 1
-            switch_depth = switch_stack.pop()
-
-        # Exit main if braces close up
-        if closed_count > 0 and brace_depth <= 0:
-            assert(switch_nesting == 0)
-            # Because of conditional compilation, there could be more than one
-            # `main`, e.g., there could be stubbed out `main` for certain build
-            # modes.  Return the cases from the first `main` that has a switch
-            # statement.
-            if cases:
-                return cases
-            else:
-                in_main = False
+        elif kind == 'braces' and in_main:
+            brace_depth += line.count('{')
+            if '}' in line:
+                brace_depth -= line.count('}')
+                if closing_line_end < 0:
+                    closing_line_end = code.find('\n', pos)
+                    if closing_line_end < 0:
+                        closing_line_end = len(code)
 
 def renumber_testcases(code, testcases):
     """Renumber the test cases in the specified `code` and return the result.
-    The `testcases` parameter is a list of tuples, `(line-index`, case-label)`
-    indicating the line index and case labels in the original `code`.  The
+    The `testcases` parameter is a list of tuples, `(line-start`, case-label)`
+    indicating the line offsets and case labels in the original `code`.  The
     returned string has two types of modifications with respect to `code`:
 
     1. The case labels are changed to strictly descending integers starting
@@ -114,56 +199,140 @@ def renumber_testcases(code, testcases):
        n is a testcase label is renumbered to correspond to the new case lable.
 
     Note that `testcases` is assumed to be sorted in ascending order by line
-    number."""
-
-    lines = code.split('\n')
+    start.  The result is assembled from slices of `code` between the edits."""
 
     # Create a mapping of old testcase labels to new testcase labels
     testcase_map = {}
     new_testnum = len(testcases)
-    for lineidx, old_caselabel in testcases:
+    for line_start, old_caselabel in testcases:
         new_caselabel = str(new_testnum)
         testcase_map[old_caselabel] = new_caselabel
         new_testnum -= 1
-    assert(0 == new_testnum)
+    if new_testnum != 0:
+        raise ValueError("test cases were not all renumbered")
+
+    pieces = []
+    pos    = 0
 
     # Update testcase labels in test plan at top of file
-    first_testline = testcases[0][0]  # Line index of first case
-    for lineidx, line in enumerate(lines):
-        if lineidx >= first_testline:
-            break;
-        planitem_m = planitem_re.match(line)
-        if planitem_m:
-            old_caselabel = planitem_m[1]
-            new_caselabel = testcase_map.get(old_caselabel, "  ")
-            if len(new_caselabel) < 2: new_caselabel = ' ' + new_caselabel
-            line = planitem_re.sub(f"// [{new_caselabel}]", line)
-            lines[lineidx] = line;
+    first_testline = testcases[0][0]  # Offset of line of first case
+    for planitem_m in planitem_re.finditer(code, 0, first_testline):
+        old_caselabel = planitem_m[1]
+        new_caselabel = testcase_map.get(old_caselabel, "  ")
+        if len(new_caselabel) < 2: new_caselabel = ' ' + new_caselabel
+        pieces += [code[pos:planitem_m.start()], f"// [{new_caselabel}]"]
+        pos = planitem_m.end()
 
     # Update testcase labels in `main`
-    for lineidx, old_caselabel in testcases:
-        line = lines[lineidx]
+    for line_start, old_caselabel in testcases:
+        case_m = case_re.match(code, line_start)
+        if not case_m:
+            continue
         new_caselabel = testcase_map[old_caselabel]
-        line = case_re.sub(f"      case {new_caselabel}:", line)
-        lines[lineidx] = line;
+        pieces += [code[pos:line_start], f"      case {new_caselabel}:"]
+        pos = case_m.end()
 
-    return '\n'.join(lines)
+    pieces.append(code[pos:])
+    return ''.join(pieces)
 
-# Run on the first file
-filename = sys.argv[1]
+def renumber_file(filename, check = False):
+    """Renumber the test cases in the test driver `filename` and return the
+    tuple `(status, message)`, where `status` is "changed", "unchanged" or
+    "error".  If `check` is true, report whether the driver would change but
+    do not write anything."""
+    try:
+        with open(filename, 'r') as file:
+            oldcode = file.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return "error", f"{filename}: {e}"
 
-with open(filename, 'r') as file:
-    # Remove comments before processing lines
-    oldcode = file.read()
+    try:
+        testcases = find_case_lines(oldcode)
+        if not testcases:
+            return "error", f"{filename}: no test cases found"
 
-testcases = find_case_lines(oldcode)
+        newcode = renumber_testcases(oldcode, testcases)
+    except ValueError as e:
+        return "error", f"{filename}: {e}"
 
-newcode = renumber_testcases(oldcode, testcases)
-
-if newcode == oldcode:
-    print("No changes")
-else:
+    if newcode == oldcode:
+        return "unchanged", "No changes"
+    elif check:
+        return "changed", f"{filename}: test cases would be renumbered"
     os.replace(filename, filename + ".bak")
     with open(filename, 'w') as file:
         file.write(newcode)
-    print(f"Renumbering complete. Old file saved as {filename}.bak.")
+    return "changed", \
+        f"Renumbering complete. Old file saved as {filename}.bak."
+
+def find_test_drivers(paths):
+    """Return a list of the test drivers named by `paths`, each of which is
+    either a file, or a directory to search recursively, in sorted order
+    within each directory"""
+    ret = []
+    for path in paths:
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            ret += [os.path.join(dirpath, filename)
+                    for filename in sorted(filenames)
+                    if test_driver_re.search(filename)]
+    return ret
+
+def usage(error_str = None):
+    if error_str is not None:
+        print(error_str, file=sys.stderr)
+    print("Usage: renumber_tests.py [--check] [--jobs <n>] "
+          "<filename|directory>...", file=sys.stderr)
+    sys.exit(2)
+
+def renumber_worker(args):
+    return renumber_file(*args)
+
+if __name__ == "__main__":
+    check = False
+    jobs  = os.cpu_count() or 1
+    paths = []
+    args  = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--check":
+            check = True
+        elif arg in ("--jobs", "-j"):
+            jobs = next(args, "")
+            if not jobs.isdigit() or int(jobs) == 0:
+                usage("--jobs requires a positive numeric argument")
+            jobs = int(jobs)
+        elif arg.startswith("-"):
+            usage(f"Invalid option: {arg}")
+        else:
+            paths.append(arg)
+    if not paths:
+        usage()
+
+    filenames = find_test_drivers(paths)
+    work      = [(filename, check) for filename in filenames]
+    if jobs > 1 and len(filenames) >= 4 * jobs:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(
+                renumber_worker, work,
+                chunksize=max(1, len(filenames) // (jobs * 8))))
+    else:
+        results = list(map(renumber_worker, work))
+
+    counts = { "changed" : 0, "unchanged" : 0, "error" : 0 }
+    for status, message in results:
+        counts[status] += 1
+        if len(filenames) == 1 or status != "unchanged":
+            print(message, file=sys.stderr if status == "error" else
+                  sys.stdout)
+    if len(filenames) > 1:
+        print(f"{len(filenames)} test drivers: {counts['changed']} " +
+              ("would be renumbered" if check else "renumbered") +
+              f", {counts['unchanged']} unchanged, {counts['error']} errors")
+
+    if counts["error"]:
+        sys.exit(2)
+    if check and counts["changed"]:
+        sys.exit(1)